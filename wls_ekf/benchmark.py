@@ -0,0 +1,245 @@
+## micro and macro benchmarks of the positioning hot path
+
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import subprocess
+import multiprocessing
+import numpy as np
+from wls import *
+from ekf import *
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DATA = os.path.join(BASE_DIR, 'data', 'Opensky')
+# per user, outside the source tree
+BENCH_HISTORY = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                             'wls_ekf', 'benchmark_history.jsonl')
+BENCH_THRESHOLD = 0.2   # relative slowdown reported as a regression
+BENCH_BASELINE = 5      # number of previous runs the baseline is the median of
+BENCH_EPOCH = 100       # epoch used by the micro-benchmarks
+BENCH_MIN_TIME = 0.2    # minimum measuring time per micro-benchmark (s)
+
+
+def _time_call(func, repeat=5):
+    """ best time per call (s) of func over repeat runs of at least
+    BENCH_MIN_TIME each """
+    timer = timeit.Timer(func)
+    number, t = timer.autorange()
+    number = max(1, int(number * BENCH_MIN_TIME / max(t, 1e-9)))
+    return min(timer.repeat(repeat, number)) / number
+
+
+def micro_benchmarks(data_dir=BENCH_DATA):
+    """ time per call (us) of the hot path functions on one Opensky epoch """
+    all_obs = read_obs_mat(os.path.join(data_dir, 'obsData.mat'))
+    all_eph = read_eph_mat(os.path.join(data_dir, 'ephData.mat'))
+    obs = all_obs[BENCH_EPOCH]
+    ns = len(obs.sat)
+    rs, dts = satposs(obs, all_eph)
+    x, _, _ = estpos(ns, obs, all_eph, rs, dts)
+    pos = ecef2pos(x[0:3])
+    e = (rs[:, 0:3] - x[0:3]) / norm(rs[:, 0:3] - x[0:3], axis=1)[:, None]
+    az, el = satazel(pos, e[0])
+    eph = seleph(obs.sat[0], all_eph, obs.t[0])
+    t = gpst2time(obs.week[0], obs.t[0])
+    tgd = epoch_tgd(obs, all_eph)
+    nv, v, H, w = design_matrix(1, obs, all_eph, rs, dts, x, tgd)
+    packed = all_obs.pack(np.flatnonzero(all_obs.nsat >= 4))
+    rs_all, dts_all = satposs_batch(packed.sat, packed.t, all_eph)
+    tgd_all = epoch_tgd(packed, all_eph)
+    x_all = np.tile(x, (len(packed.P), 1))
+    _, P = initialize_ekf_state()
+    orbit = OrbitCache(all_eph)
+
+    benches = {
+        'eph2pos': lambda: eph2pos(obs.t[0], eph),
+        'satposs': lambda: satposs(obs, all_eph),
+        'satposs_orbit': lambda: satposs(obs, all_eph, orbit=orbit),
+        'satposs_batch_session': lambda: satposs_batch(packed.sat, packed.t, all_eph),
+        'ecef2pos': lambda: ecef2pos(x[0:3]),
+        'ecef2pos_batch_session': lambda: ecef2pos_batch(x_all[:, 0:3]),
+        'satazel': lambda: satazel(pos, e[0]),
+        'satazel_batch': lambda: satazel_batch(pos, e),
+        'ionmodel': lambda: ionmodel(obs.t[0], pos, az, el),
+        'tropmapf': lambda: tropmapf(t, pos, el),
+        'design_matrix': lambda: design_matrix(1, obs, all_eph, rs, dts, x, tgd),
+        'design_matrix_batch_session': lambda: design_matrix_batch(1, packed, rs_all, dts_all,
+                                                                   x_all, tgd_all),
+        'lst': lambda: lst(H, w, v),
+        'ekf_iteration': lambda: ekf_iteration(ns, obs, all_eph, rs, dts, x, P, 0.1),
+        'ekf_iteration_iterated': lambda: ekf_iteration(ns, obs, all_eph, rs, dts, x, P, 0.1,
+                                                        EKF_ITERATED),
+    }
+    results = {}
+    for name, func in benches.items():
+        results['micro.' + name] = {'value': _time_call(func) * 1e6, 'unit': 'us',
+                                    'better': 'lower'}
+        print("%-40s %12.2f us" % (name, results['micro.' + name]['value']))
+    return results
+
+
+def _peak_rss_mb():
+    """ peak resident set size of this process (MB), None if unknown """
+    status = _proc_status()
+    if 'VmHWM' in status:
+        return status['VmHWM']
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return rss / 1024.0 ** (2 if sys.platform == 'darwin' else 1)
+
+
+def _proc_status():
+    """ memory fields (MB) of /proc/self/status, empty where there is none """
+    try:
+        with open('/proc/self/status') as f:
+            return {k: int(v.split()[0]) / 1024.0 for k, v in
+                    (line.split(':', 1) for line in f) if k in ('VmRSS', 'VmHWM')}
+    except OSError:
+        return {}
+
+
+def _reset_peak_rss():
+    """ restart the peak RSS from the current RSS (linux), so the peak of a
+    run does not include transient import memory; True if done """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _macro_run(method, data_dir):
+    """ one end-to-end run of the streaming estimator in a fresh process:
+    epochs/s of the whole session (start to last result), time to the
+    first result, the RSS after the imports and the growth of the peak RSS
+    over the run, all of the same run """
+    from scipy.linalg import lapack  # imported by lst on first use
+    rss0 = _proc_status()['VmRSS'] if _reset_peak_rss() else _peak_rss_mb()
+    obs_filename = os.path.join(data_dir, 'obsData.mat')
+    eph_filename = os.path.join(data_dir, 'ephData.mat')
+    stream = WLS_pos_vel_stream if method == 'wls' else EKF_pos_vel_stream
+    n, ttff = 0, None
+    t0 = time.perf_counter()
+    rows = stream(obs_filename, eph_filename)
+    try:
+        for _ in rows:
+            n += 1
+            if ttff is None:
+                ttff = time.perf_counter() - t0
+        sec = time.perf_counter() - t0
+    finally:
+        rows.close()
+    rss = _peak_rss_mb()
+    return n / sec if sec > 0 else 0.0, ttff or 0.0, rss0, rss - rss0 if rss0 is not None else None
+
+
+def macro_benchmarks(data_dir=BENCH_DATA):
+    """ epochs/s, time to first fix and RSS (after the imports, and the
+    growth over the run) of WLS and EKF on a dataset, each in its own
+    process so that the RSS peaks do not mix """
+    # build the binary cache first, the runs time the cached load
+    read_obs_mat(os.path.join(data_dir, 'obsData.mat'))
+    read_eph_mat(os.path.join(data_dir, 'ephData.mat'))
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for method in ['wls', 'ekf']:
+        with ctx.Pool(1) as pool:
+            rate, ttff, rss0, rss = pool.apply(_macro_run, (method, data_dir))
+        results['macro.%s.epochs_per_s' % method] = {'value': rate, 'unit': 'epochs/s',
+                                                     'better': 'higher'}
+        results['macro.%s.ttff' % method] = {'value': ttff * 1e3, 'unit': 'ms', 'better': 'lower'}
+        if rss is not None:
+            results['macro.%s.import_rss' % method] = {'value': rss0, 'unit': 'MB',
+                                                       'better': 'lower'}
+            results['macro.%s.run_rss' % method] = {'value': rss, 'unit': 'MB', 'better': 'lower'}
+        print("%-40s %12.1f epochs/s  ttff %8.1f ms  rss %s MB + %s MB"
+              % (method, rate, ttff * 1e3, "%.1f" % rss0 if rss0 is not None else '-',
+                 "%.1f" % rss if rss is not None else '-'))
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(filename):
+    """ benchmark records of a JSONL history file, oldest first """
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(filename, results):
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': _git_commit(),
+              'python': platform.python_version(), 'numpy': np.__version__,
+              'machine': platform.machine(), 'results': results}
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    with open(filename, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+
+def find_regressions(results, history, threshold=BENCH_THRESHOLD, nbase=BENCH_BASELINE):
+    """ metrics worse than the median of the last nbase runs by more than
+    threshold (relative), as (name, value, baseline, change) """
+    regressions = []
+    for name, res in results.items():
+        base = [h['results'][name]['value'] for h in history[-nbase:] if name in h['results']]
+        if not base:
+            continue
+        base = float(np.median(base))
+        change = (res['value'] - base) / base if base else 0.0
+        if res['better'] == 'higher':
+            change = -change
+        if change > threshold:
+            regressions.append((name, res['value'], base, change))
+    return regressions
+
+
+def main(argv=None):
+    """
+    python benchmark.py [--micro] [--macro] [--history file] [--threshold r]
+    runs both levels by default, appends the results to the history and
+    exits with status 1 if a metric regressed against the previous runs
+    """
+    parser = argparse.ArgumentParser(description="benchmarks of the positioning hot path")
+    parser.add_argument('--micro', action='store_true', help="run the micro-benchmarks")
+    parser.add_argument('--macro', action='store_true', help="run the macro-benchmarks")
+    parser.add_argument('--data', default=BENCH_DATA, help="dataset directory")
+    parser.add_argument('--history', default=BENCH_HISTORY, help="JSONL history file")
+    parser.add_argument('--threshold', type=float, default=BENCH_THRESHOLD,
+                        help="relative slowdown reported as a regression")
+    parser.add_argument('--no-record', action='store_true', help="do not append to the history")
+    args = parser.parse_args(argv)
+    run_all = not (args.micro or args.macro)
+
+    results = {}
+    if args.micro or run_all:
+        results.update(micro_benchmarks(args.data))
+    if args.macro or run_all:
+        results.update(macro_benchmarks(args.data))
+    history = read_history(args.history)
+    regressions = find_regressions(results, history, args.threshold)
+    if not args.no_record:
+        append_history(args.history, results)
+    for name, value, base, change in regressions:
+        print("REGRESSION %-40s %12.2f vs %12.2f (%+.0f%%)" % (name, value, base, change * 100))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
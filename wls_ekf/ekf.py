@@ -6,10 +6,20 @@ from gnsscommon import *
 from ionosphere import *
 from troposphere import *
 from read_mat import *
+from orbitcache import *
+from design import *
+from raim import *
 
 MAXITR = 10  # max number of iteration or point pos
-REL_HUMI = 0.7  # relative humidity for Saastamoinen model
-MIN_EL = np.deg2rad(5)  # min elevation for measurement
+
+# measurement update modes of ekf_iteration
+EKF_JOSEPH = 'joseph'          # all measurements at once, inv(S), Joseph form
+EKF_SEQUENTIAL = 'sequential'  # one scalar measurement at a time, no inverse
+EKF_SQRT = 'sqrt'              # Potter square root, P kept as a factor S S'
+EKF_ITERATED = 'iterated'      # iterated EKF, one update from the last linearization
+
+RELIN_DIST = 1.0   # position step (m) below which relinearizing is not needed
+MAHA_TOL = 1e-3    # relative change of the innovation mahalanobis distance to stop
 
 def state_transition(x, dt):
     """
@@ -24,79 +34,13 @@ def state_transition(x, dt):
     return x_pred, F
 
 
-def design_matrix_ekf(iter, ns, obs, eph, rs, dts, x):
+def design_matrix_ekf(iter, ns, obs, eph, rs, dts, x, atmos=None, exclude=None):
     """
     为EKF构建设计矩阵和残差向量
     """
-    v = np.zeros(ns * 2)
-    H = np.zeros([ns * 2, 8])
-    R = np.zeros([ns * 2, ns * 2])
-
-    rr = x[0:3]
-    dtr = x[3]
-    rv = x[4:7]
-    dtrv = x[7]
-    pos = ecef2pos(rr)
-    nv = 0
-
-    for i in range(ns):
-        if norm(rs[i, :3]) < rCST.RE_WGS84:
-            continue
-        r, e = geodist(rs[i, :3], rr)
-        ev = geodist_v(rs[i, 3:6], rv, r)
-        if r < 0:
-            continue
-        [az, el] = satazel(pos, e)
-        if el < MIN_EL:
-            continue
-        if iter > 0:
-            # ionospheric correction
-            dion = ionmodel(obs.t[0], pos, az, el)
-            # tropospheric correction
-            gpst2time(obs.week[i], obs.t[i])
-            trop_hs, trop_wet, _ = tropmodel(pos, el, REL_HUMI)
-            mapfh, mapfw = tropmapf(gpst2time(obs.week[i], obs.t[i]), pos, el)
-            dtrp = mapfh * trop_hs + mapfw * trop_wet
-        else:
-            dion = dtrp = 0
-        # TGD correction
-        if obs.P[i] == 0:
-            continue
-        tmp_eph = seleph(obs.sat[i], eph)
-        p_range = obs.P[i] - tmp_eph.tgd * rCST.CLIGHT
-        # pseudorange residual
-        v[nv] = p_range - (r + dtr - rCST.CLIGHT * dts[i, 0] + dion + dtrp)
-        H[nv, 0:3] = -e
-        # design matrix for clock bias
-        H[nv, 3] = 1
-        R[nv, nv] = 1 / get_weight_based_elevation(el) * 3
-        nv += 1
-        # Doppler measurement
-        if obs.D[i] == 0:
-            continue
-        doppler_measurement = -obs.D[i]  # * rCST.CLIGHT / rCST.GPS_L1_FREQ
-        # range rate
-        range_rate = np.sum((rs[i, :3] - rr) * (rs[i, 3:] - rv)) / r
-        # clock rate
-        clock_rate = dtrv - dts[i, 1] * rCST.CLIGHT
-        # earth correction rate
-        earth_correction_rate = rCST.OMGE * (
-                    rs[i, 3] * rr[1] + rv[1] * rs[i, 0] - rs[i, 4] * rr[0] - rv[0] * rs[i, 1]) / rCST.CLIGHT
-        # velocity components of design matrix
-        H[nv, 0] = -ev[0] + e[0] * (e[0] * ev[0] + e[1] * ev[1] + e[2] * ev[2])
-        H[nv, 1] = -ev[1] + e[1] * (e[0] * ev[0] + e[1] * ev[1] + e[2] * ev[2])
-        H[nv, 2] = -ev[2] + e[2] * (e[0] * ev[0] + e[1] * ev[1] + e[2] * ev[2])
-        H[nv, 4:7] = -e
-        H[nv, 7] = 1  # clock drift
-        v[nv] = doppler_measurement - (range_rate + clock_rate + earth_correction_rate)
-        R[nv, nv] = R[nv - 1, nv - 1] / 5
-        nv += 1
-    v = v[:nv]
-    H = H[:nv, :]
-    R_valid = np.zeros((nv, nv))
-    for i in range(nv):
-        R_valid[i, i] = R[i, i]
-    return nv, v, H, R_valid
+    nv, v, H, w = design_matrix(iter, obs, eph, rs, dts, x, atmos=atmos, exclude=exclude)
+    R = np.diag(3 / w)
+    return nv, v, H, R
 
 
 def initialize_ekf_state():
@@ -126,54 +70,294 @@ def init_process_noise(dt):
     return Q
 
 
-def ekf_iteration(ns, obs, eph, rs, dts, x, P, dt):
+def ekf_update(P, H, v, R):
     """
-    执行一次EKF迭代
+    全部观测一次更新 (Joseph form), return dx and the updated P
+    """
+    HP = H @ P
+    S = HP @ H.T + R
+    K = P @ H.T @ inv(S)
+    dx = K @ v
+    I_KH = np.eye(len(P)) - K @ H
+    P = I_KH @ P @ I_KH.T + K @ R @ K.T
+    return dx, P
+
+
+def ekf_update_sequential(P, H, v, r):
+    """
+    逐个标量观测更新, r is the diagonal of R
+
+    with uncorrelated measurements the batch update equals a sequence of
+    scalar updates, each innovation taken at the state updated so far, so
+    S is a scalar and no matrix is inverted
+    """
+    dx = np.zeros(len(P))
+    for h, vi, ri in zip(H, v, r):
+        Ph = P @ h
+        k = Ph / (h @ Ph + ri)
+        dx += k * (vi - h @ dx)
+        P = P - np.outer(k, Ph)
+    # keep P symmetric against rounding
+    return dx, (P + P.T) / 2
+
+
+def ekf_update_sqrt(S, H, v, r):
+    """
+    平方根形式的逐个标量观测更新 (Potter), S is a square root factor of
+    P = S S', r is the diagonal of R; return dx and the updated factor
+    """
+    dx = np.zeros(len(S))
+    for h, vi, ri in zip(H, v, r):
+        phi = S.T @ h
+        a = 1.0 / (phi @ phi + ri)
+        Sphi = S @ phi
+        dx += a * Sphi * (vi - h @ dx)
+        S = S - (a / (1.0 + np.sqrt(a * ri))) * np.outer(Sphi, phi)
+    return dx, S
+
+
+def ekf_predict_sqrt(x, S, dt):
+    """
+    平方根形式的预测: the factor of F P F' + Q is the triangular factor of
+    a QR decomposition of [F S, sqrt(Q)]', so P itself is never formed
     """
     x_pred, F = state_transition(x, dt)
     Q = init_process_noise(dt)
-    P_pred = F @ P @ F.T + Q
-    for iter in range(MAXITR):
-        nv, v, H, R = design_matrix_ekf(iter, ns, obs, eph, rs, dts, x_pred)
+    R = np.linalg.qr(np.hstack([F @ S, np.sqrt(Q)]).T, mode='r')
+    return x_pred, R.T
+
+
+def fde_ekf(obs, eph, rs, dts, x_pred, P_pred, atmos, tgd=None, sqrt=False):
+    """
+    fault detection and exclusion on the innovations of the prediction
+
+    the innovations of all satellites at x_pred, with atmospheric
+    corrections, are tested against S = H P_pred H' + R where R holds the
+    variances of the RAIM test model (the filter weights 3/w are only
+    relative), see raim.fde_innovation. no test is made before the filter
+    has a position, and exclusions are kept only if the remaining
+    innovations pass: a failing set is rather a bad prediction (e.g. while
+    the filter converges) than faulty satellites. return the boolean mask
+    of the excluded satellites, None if nothing is excluded; P_pred is a
+    square root factor if sqrt
+    """
+    if norm(x_pred[0:3]) < rCST.RE_WGS84 / 2:
+        return None
+    tic = TELEMETRY.tic()
+    nv, v, H, w, sat = design_matrix(1, obs, eph, rs, dts, x_pred, tgd, atmos, sats=True)
+    if nv < 8:
+        return None
+    if sqrt:
+        P_pred = P_pred @ P_pred.T
+    S = H @ P_pred @ H.T + np.diag(test_variance(w))
+    excluded, _, passed = fde_innovation(v, S, sat)
+    TELEMETRY.toc('fde', tic)
+    if not excluded or not passed:
+        return None
+    TELEMETRY.fault(np.asarray(obs.sat)[excluded])
+    exclude = np.zeros(len(obs.sat), dtype=bool)
+    exclude[excluded] = True
+    return exclude
+
+
+def ekf_iteration(ns, obs, eph, rs, dts, x, P, dt, mode=EKF_JOSEPH, counts=None,
+                  maxiter=MAXITR, fde=False):
+    """
+    执行一次EKF迭代
+
+    mode selects the measurement update: EKF_JOSEPH (ekf_update),
+    EKF_SEQUENTIAL (ekf_update_sequential), EKF_SQRT (ekf_update_sqrt,
+    P is then the square root factor of the covariance on input and output)
+    or EKF_ITERATED (ekf_iterated). if counts is a list, the number of
+    iterations (design matrix builds) of the epoch is appended to it.
+    maxiter caps the iterations (e.g. to meet a real-time deadline). with
+    fde satellites failing the innovation test are left out (see fde_ekf)
+    """
+    if mode == EKF_ITERATED:
+        return ekf_iterated(ns, obs, eph, rs, dts, x, P, dt, counts, maxiter, fde)
+    if mode == EKF_SQRT:
+        x_pred, P_pred = ekf_predict_sqrt(x, P, dt)
+    else:
+        x_pred, F = state_transition(x, dt)
+        Q = init_process_noise(dt)
+        P_pred = F @ P @ F.T + Q
+    atmos = epoch_atmos(obs)
+    exclude = None
+    if fde:
+        exclude = fde_ekf(obs, eph, rs, dts, x_pred, P_pred, atmos, sqrt=mode == EKF_SQRT)
+    for iter in range(maxiter):
+        if mode == EKF_JOSEPH:
+            nv, v, H, R = design_matrix_ekf(iter, ns, obs, eph, rs, dts, x_pred, atmos, exclude)
+        else:
+            nv, v, H, w = design_matrix(iter, obs, eph, rs, dts, x_pred, atmos=atmos,
+                                        exclude=exclude)
+            r = 3 / w
 
         if nv < 8:
-            return x_pred, P_pred
-        HP = H @ P_pred
-        S = HP @ H.T + R
-        K = P_pred @ H.T @ inv(S)
-        dx = K @ v
+            TELEMETRY.iteration(nv)
+            break
+        tic = TELEMETRY.tic()
+        if mode == EKF_JOSEPH:
+            dx, P_pred = ekf_update(P_pred, H, v, R)
+        elif mode == EKF_SEQUENTIAL:
+            dx, P_pred = ekf_update_sequential(P_pred, H, v, r)
+        else:
+            dx, P_pred = ekf_update_sqrt(P_pred, H, v, r)
+        TELEMETRY.toc('solve', tic)
         x_pred = x_pred + dx
-        I_KH = np.eye(8) - K @ H
-        P_pred = I_KH @ P_pred @ I_KH.T + K @ R @ K.T
+        TELEMETRY.iteration(nv, norm(dx))
         if norm(dx) < 1e-4:
             break
+    if counts is not None:
+        counts.append(iter + 1)
     return x_pred, P_pred
 
 
-def EKF_pos_vel_estimation(obs_filename, eph_filename):
+def ekf_iterated(ns, obs, eph, rs, dts, x, P, dt, counts=None, maxiter=MAXITR, fde=False):
     """
-    使用EKF估计位置和速度
+    迭代EKF (Gauss-Newton form)
+
+    the measurements are relinearized at the current iterate x_i and the
+    prediction is updated once from there,
+        x_i+1 = x_pred + K_i (v_i - H_i (x_pred - x_i)),
+    P is updated only with the gain of the last linearization. TGD,
+    satellite states and atmospheric delays (AtmosCache) are kept over the
+    iterations. the model is linear in clock, velocity and clock drift, so
+    a new linearization can only change the result when the position moved:
+    the loop stops once the position step is below RELIN_DIST or the
+    mahalanobis distance of the innovation changed by less than MAHA_TOL
+    (relative). atmospheric delays enter from the second linearization on,
+    so at least two are made. if counts is a list, the number of iterations
+    of the epoch is appended to it, maxiter caps the linearizations. a
+    linearization with fewer than 8 measurements ends the loop and the
+    update of the last good one is kept. with fde satellites failing the
+    innovation test are left out (see fde_ekf)
+    """
+    x_pred, F = state_transition(x, dt)
+    Q = init_process_noise(dt)
+    P_pred = F @ P @ F.T + Q
+    atmos = epoch_atmos(obs)
+    tgd = epoch_tgd(obs, eph)
+    exclude = fde_ekf(obs, eph, rs, dts, x_pred, P_pred, atmos, tgd) if fde else None
+    xi = x_pred
+    maha = None
+    K = None
+    for iter in range(maxiter):
+        model = design_matrix(iter, obs, eph, rs, dts, xi, tgd, atmos, exclude)
+        if model[0] < 8:
+            # H and R stay those of the last update
+            TELEMETRY.iteration(model[0])
+            break
+        nv, v, H, w = model
+        tic = TELEMETRY.tic()
+        R = np.diag(3 / w)
+        PHt = P_pred @ H.T
+        S = H @ PHt + R
+        y = v - H @ (x_pred - xi)
+        K = np.linalg.solve(S, PHt.T).T
+        x_next = x_pred + K @ y
+        step = norm(x_next[0:3] - xi[0:3])
+        maha_next = y @ np.linalg.solve(S, y)
+        TELEMETRY.toc('solve', tic)
+        TELEMETRY.iteration(nv, norm(x_next - xi))
+        xi = x_next
+        if iter > 0 and (step < RELIN_DIST or
+                         abs(maha_next - maha) < MAHA_TOL * max(maha_next, 1.0)):
+            break
+        maha = maha_next
+    if counts is not None:
+        counts.append(iter + 1)
+    if K is None:
+        return x_pred, P_pred
+    I_KH = np.eye(8) - K @ H
+    return xi, I_KH @ P_pred @ I_KH.T + K @ R @ K.T
+
+
+def EKF_pos_vel_estimation(obs_filename, eph_filename, mode=EKF_JOSEPH, fde=False,
+                           counts=None):
+    """
+    使用EKF估计位置和速度, mode is the measurement update and fde the fault
+    detection and exclusion, counts collects the per-epoch iteration counts
+    (see ekf_iteration)
     """
-    out = []
     all_obs = read_obs_mat(obs_filename)
     all_eph = read_eph_mat(eph_filename)
+    return list(iter_ekf(all_obs, all_eph, mode=mode, counts=counts, fde=fde))
 
-    x, P = initialize_ekf_state()
-    prev_time = None
 
-    for i in range(len(all_obs)):
-        obs = all_obs[i]
-        ns = len(obs.sat)
-        if ns < 4:
-            continue
-        rs, dts = satposs(obs, all_eph)
+class EkfFilter():
+    """ EKF state kept across epochs, fed one epoch at a time
+
+    update filters one epoch (at least 4 satellites) and returns its result
+    row; the time step is taken from the transmit times of consecutive
+    updated epochs, so skipped epochs are bridged by the prediction.
+    """
+
+    def __init__(self, all_eph, mode=EKF_JOSEPH, orbit=None, fde=False):
+        self.all_eph = all_eph
+        self.mode = mode
+        self.orbit = orbit
+        self.fde = fde
+        self.x, self.P = initialize_ekf_state()
+        if mode == EKF_SQRT:
+            self.P = np.linalg.cholesky(self.P)
+        self.prev_time = None
 
+    def update(self, obs, rs=None, dts=None, counts=None, maxiter=MAXITR):
+        """ filter one epoch, rs and dts are computed if not given """
+        ns = len(obs.sat)
+        if rs is None:
+            tic = TELEMETRY.tic()
+            rs, dts = satposs(obs, self.all_eph, orbit=self.orbit)
+            TELEMETRY.toc('satposs', tic)
         current_time = obs.t[0]
-        if prev_time is None:
+        if self.prev_time is None:
             dt = 0.1
         else:
-            dt = current_time - prev_time
-        prev_time = current_time
-        x, P = ekf_iteration(ns, obs, all_eph, rs, dts, x, P, dt)
-        out.append([obs.t[0], x[0], x[1], x[2], x[4], x[5], x[6]])
-    return out
+            dt = current_time - self.prev_time
+        self.prev_time = current_time
+        self.x, self.P = ekf_iteration(ns, obs, self.all_eph, rs, dts, self.x, self.P, dt,
+                                       self.mode, counts, maxiter, self.fde)
+        x = self.x
+        return [obs.t[0], x[0], x[1], x[2], x[4], x[5], x[6]]
+
+
+def iter_ekf(all_obs, all_eph, orbit=None, mode=EKF_JOSEPH, counts=None, fde=False):
+    """
+    EKF result row of each epoch of the iterable all_obs, yielded as soon
+    as the epoch is filtered. for an ObsStore the satellite states of all
+    epochs are computed in one pass and sliced per epoch. counts collects
+    the per-epoch iteration counts (see ekf_iteration)
+    """
+    ekf = EkfFilter(all_eph, mode, orbit, fde)
+    session = isinstance(all_obs, ObsStore)
+    if session:
+        tic = TELEMETRY.tic()
+        rs_all, dts_all = satposs_batch(all_obs.sat, all_obs.t, all_eph, orbit=orbit)
+        TELEMETRY.toc('satposs', tic)
+
+    for i, obs in enumerate(all_obs):
+        if len(obs.sat) < 4:
+            continue
+        TELEMETRY.begin_epoch(obs.t[0], len(obs.sat))
+        rs = dts = None
+        if session:
+            a, b = all_obs.offsets[i], all_obs.offsets[i + 1]
+            rs, dts = rs_all[a:b], dts_all[a:b]
+        row = ekf.update(obs, rs, dts, counts)
+        TELEMETRY.end_epoch()
+        yield row
+
+
+def EKF_pos_vel_stream(obs_filename, eph_filename, mode=EKF_JOSEPH, fde=False,
+                       orbit_cache_dir=None, counts=None):
+    """
+    streaming EKF: epochs are read lazily and results are yielded one by
+    one, nothing is accumulated over the session. with orbit_cache_dir
+    the satellite states of every epoch are interpolated from Chebyshev
+    fits persisted there (see OrbitCache), counts collects the per-epoch
+    iteration counts (see ekf_iteration)
+    """
+    all_eph = read_eph_mat(eph_filename)
+    orbit = OrbitCache(all_eph, cache_dir=orbit_cache_dir) if orbit_cache_dir else None
+    return iter_ekf(iter_obs_mat(obs_filename), all_eph, orbit, mode, counts, fde)
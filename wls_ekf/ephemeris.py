@@ -5,14 +5,149 @@ url: https://github.com/rtklibexplorer/rtklib-py
 
 """
 
+from bisect import bisect_left
 import numpy as np
 from gnsscommon import *
 
 # ephemeris parameters
 MAX_ITER_KEPLER = 30
 RTOL_KEPLER = 1e-13
+VEL_ANALYTIC = 'analytic'  # closed-form velocity and clock drift
+VEL_DIFF = 'diff'          # finite difference of two eph2pos evaluations
+MAXDTOE = 7200.0           # max time difference to GPS toe (s)
+EPH_FIELDS = ['sat', 'iode', 'iodc', 'f0', 'f1', 'f2', 'toc', 'toe', 'week',
+              'crs', 'crc', 'cus', 'cuc', 'cis', 'cic', 'e', 'i0', 'A', 'deln',
+              'M0', 'OMG0', 'OMGd', 'omg', 'idot', 'tgd', 'sva', 'health', 'toes']
+# derived constants cached alongside the stacked ephemeris fields
+EPH_DERIVED = ['n', 'sqrtmuA', 'sq1e2']
+EPH_CLOCK = ['toc', 'f0', 'f1', 'f2']  # fields used by eph2clk
 
-def seleph(sat, all_eph):
+class EphStore():
+    """ ephemeris store indexed by satellite and sorted by toe
+
+    Ephemerides are kept in insertion order (iterating the store behaves
+    like the plain list returned before), plus a per-satellite index of
+    toe-sorted records for O(1) satellite lookup and O(log n) selection of
+    the set nearest to a given time. All records are also stacked into one
+    array-valued Eph (see stack_eph) with derived constants precomputed,
+    which the batch satellite engine gathers from directly.
+    """
+
+    def __init__(self, ephs=()):
+        self._ephs = []
+        self._index = None
+        self._keys = None
+        self._table = None
+        for eph in ephs:
+            self.add(eph)
+
+    @classmethod
+    def from_table(cls, table):
+        """ store over an Eph with array fields (see stack_eph), e.g. views
+        of shared memory; the arrays are used as they are and the per-record
+        Eph objects are only built if the store is iterated or indexed """
+        store = cls()
+        store._ephs = None
+        store._table = table
+        if not all(name in vars(table) for name in EPH_DERIVED):
+            eph_derived(table)
+        return store
+
+    @property
+    def ephs(self):
+        if self._ephs is None:
+            self._ephs = unstack_eph(self._table)
+        return self._ephs
+
+    def add(self, eph):
+        self.ephs.append(eph)
+        self._index = self._keys = self._table = None
+
+    def __len__(self):
+        return len(self._ephs) if self._ephs is not None else len(self._table.sat)
+
+    def __iter__(self):
+        return iter(self.ephs)
+
+    def __getitem__(self, i):
+        return self.ephs[i]
+
+    @property
+    def index(self):
+        """ sat -> (sorted toe array, row numbers into ephs) """
+        if self._index is None:
+            rows = {}
+            for k, eph in enumerate(self.ephs):
+                rows.setdefault(int(eph.sat), []).append(k)
+            self._index = {}
+            for sat, r in rows.items():
+                toe = np.array([self.ephs[k].toe for k in r], dtype=float)
+                order = np.argsort(toe, kind='stable')
+                self._index[sat] = (toe[order], np.array(r)[order])
+        return self._index
+
+    @property
+    def table(self):
+        """ all ephemerides stacked into one Eph with array fields """
+        if self._table is None:
+            self._table = stack_eph(self.ephs)
+        return self._table
+
+    @property
+    def keys(self):
+        """ (sat, toe, row) of all ephemerides sorted by sat and toe """
+        if self._keys is None:
+            sat = np.asarray(self.table.sat, dtype=float)
+            toe = np.asarray(self.table.toe, dtype=float)
+            order = np.lexsort((toe, sat))
+            self._keys = (sat[order], toe[order], order)
+        return self._keys
+
+    def select_index(self, sat, t=None):
+        """ rows of the ephemerides to use for satellites sat at times t,
+        -1 where no ephemeris is within MAXDTOE of t. without t the
+        earliest set of each satellite is returned """
+        sat = np.atleast_1d(np.asarray(sat, dtype=float))
+        if t is not None:
+            t = np.broadcast_to(np.asarray(t, dtype=float), sat.shape).ravel()
+        sat = sat.ravel()
+        ksat, ktoe, krow = self.keys
+        if len(ksat) == 0:
+            return np.full(sat.size, -1, dtype=int)
+        if t is None:
+            j = np.minimum(np.searchsorted(ksat, sat), len(ksat) - 1)
+            return np.where(ksat[j] == sat, krow[j], -1)
+        # one search over (sat, toe) for all queries, toe is below 1e6 s
+        j = np.searchsorted(ksat * 1e6 + ktoe, sat * 1e6 + t)
+        jl = np.maximum(j - 1, 0)
+        jr = np.minimum(j, len(ksat) - 1)
+        dl = np.where(ksat[jl] == sat, np.abs(dtadjust_batch(t, ktoe[jl])), np.inf)
+        dr = np.where(ksat[jr] == sat, np.abs(dtadjust_batch(t, ktoe[jr])), np.inf)
+        j = np.where(dr < dl, jr, jl)
+        return np.where(np.minimum(dl, dr) <= MAXDTOE, krow[j], -1)
+
+    def select(self, sat, t=None):
+        """ ephemeris of satellite sat nearest to time t, None if not found """
+        entry = self.index.get(int(sat))
+        if entry is None:
+            return None
+        toe, rows = entry
+        if t is None:
+            return self.ephs[rows[0]]
+        j = bisect_left(toe, t)
+        if j == len(toe) or (j > 0 and t - toe[j - 1] <= toe[j] - t):
+            j -= 1
+        if abs(dtadjust(t, toe[j])) > MAXDTOE:
+            return None
+        return self.ephs[rows[j]]
+
+
+def seleph(sat, all_eph, t=None):
+    """ select ephemeris for satellite sat, nearest valid toe to t when
+    all_eph is an EphStore. returns Eph(0) if not found """
+    if isinstance(all_eph, EphStore):
+        eph = all_eph.select(sat, t)
+        return eph if eph is not None else Eph(0)
     eph = Eph(0)
     for i in range(len(all_eph)):
         if sat == all_eph[i].sat:
@@ -87,7 +222,10 @@ def eph2pos(t, eph):
     return rs, dts
 
 
-def ephpos(time, eph):
+def ephpos(time, eph, mode=VEL_DIFF):
+    if mode == VEL_ANALYTIC:
+        rs, dts = eph2posvel_batch(np.array([time], dtype=float), stack_eph([eph]))
+        return rs[0], dts[0]
     tt = 1e-3  # delta t to calculate velocity
     rs = np.zeros(6)
     dts = np.zeros(2)
@@ -102,8 +240,8 @@ def ephpos(time, eph):
     return rs, dts
 
 
-def satpos(t, eph):
-    return ephpos(t, eph)
+def satpos(t, eph, mode=VEL_DIFF):
+    return ephpos(t, eph, mode)
 
 
 def eph2clk(time, eph):
@@ -119,11 +257,235 @@ def ephclk(time, eph):
     return eph2clk(time, eph)
 
 
-def satposs(obs, all_eph):
+def stack_eph(ephs):
+    """ stack a list of ephemerides into one Eph whose fields are arrays """
+    eph = Eph()
+    for name in EPH_FIELDS:
+        # tgd may be left at the class default [tgd1, tgd2]
+        setattr(eph, name, np.array([np.ravel(getattr(e, name))[0] for e in ephs],
+                                    dtype=float))
+    return eph_derived(eph)
+
+
+def eph_derived(eph):
+    """ add the derived constants (EPH_DERIVED) to an Eph with array fields """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eph.n = np.sqrt(rCST.MU_GPS / eph.A ** 3) + eph.deln  # mean motion
+        eph.sqrtmuA = np.sqrt(rCST.MU_GPS * eph.A)
+        eph.sq1e2 = np.sqrt(1.0 - eph.e ** 2)
+    return eph
+
+
+def unstack_eph(eph):
+    """ split an Eph with array fields back into a list of ephemerides """
+    ephs = []
+    for k in range(len(eph.sat)):
+        e = Eph(int(eph.sat[k]))
+        for name in EPH_FIELDS[1:]:
+            setattr(e, name, eph.__dict__[name][k].item())
+        ephs.append(e)
+    return ephs
+
+
+def take_eph(eph, idx, names=None):
+    """ select elements idx from an array-valued Eph, only fields names if
+    given """
+    out = Eph()
+    for name in names or EPH_FIELDS + EPH_DERIVED:
+        setattr(out, name, getattr(eph, name)[idx])
+    return out
+
+
+def dtadjust_batch(t1, t2, tw=604800):
+    """ array version of dtadjust """
+    dt = t1 - t2
+    dt = np.where(dt > tw, dt - tw, dt)
+    dt = np.where(dt < -tw, dt + tw, dt)
+    return dt
+
+
+def kepler_batch(M, e):
+    """ solve Kepler's equation E - e*sin(E) = M element-wise
+    * each element stops iterating once its own Newton step is below
+    * RTOL_KEPLER, the same criterion as the scalar loop in eph2pos """
+    E = np.array(M, dtype=float, copy=True)
+    active = np.ones(E.shape, dtype=bool)
+    for _ in range(MAX_ITER_KEPLER):
+        Ea, ea = E[active], e[active]
+        dE = (Ea - ea * np.sin(Ea) - M[active]) / (1.0 - ea * np.cos(Ea))
+        E[active] = Ea - dE
+        active[active] = np.abs(dE) >= RTOL_KEPLER
+        if not active.any():
+            break
+    return E
+
+
+def eph2pos_batch(t, eph):
+    """ array version of eph2pos --------------------------------------------
+    * args   : ndarray t        I   time (gpst), shape (n,)
+    *          Eph eph          I   ephemeris with array fields, shape (n,)
+    * return : rs (n,3) satellite positions (ecef), dts (n,) clock biases """
+    tk = dtadjust_batch(t, eph.toe)
+    omge = rCST.OMGE
+
+    M = eph.M0 + eph.n * tk
+    E = kepler_batch(M, eph.e)
+
+    sinE, cosE = np.sin(E), np.cos(E)
+    nus = eph.sq1e2 * sinE
+    nuc = cosE - eph.e
+    nue = 1.0 - eph.e * cosE
+    u = np.arctan2(nus, nuc) + eph.omg
+    r = eph.A * nue
+    i = eph.i0 + eph.idot * tk
+    sin2u, cos2u = np.sin(2 * u), np.cos(2 * u)
+    u += eph.cus * sin2u + eph.cuc * cos2u
+    r += eph.crs * sin2u + eph.crc * cos2u
+    i += eph.cis * sin2u + eph.cic * cos2u
+    x = r * np.cos(u)
+    y = r * np.sin(u)
+    cosi = np.cos(i)
+    O = eph.OMG0 + (eph.OMGd - omge) * tk - omge * eph.toes
+    sinO, cosO = np.sin(O), np.cos(O)
+    rs = np.stack([x * cosO - y * cosi * sinO, x * sinO + y * cosi * cosO,
+                   y * np.sin(i)], axis=-1)
+    tk = dtadjust_batch(t, eph.toc)
+    dts = eph.f0 + eph.f1 * tk + eph.f2 * tk ** 2
+    # relativity correction
+    dts -= 2 * eph.sqrtmuA * eph.e * sinE / rCST.CLIGHT ** 2
+    return rs, dts
+
+
+def eph2posvel_batch(t, eph):
+    """ satellite position, velocity and clock from one ephemeris evaluation --
+    * args   : ndarray t        I   time (gpst), shape (n,)
+    *          Eph eph          I   ephemeris with array fields, shape (n,)
+    * return : rs  (n,6) satellite positions and velocities (ecef)
+    *          dts (n,2) satellite clock bias and drift (s|s/s)
+    * notes  : velocity and drift are the closed-form time derivatives of
+    *          the broadcast orbit and clock model (see IS-GPS-200), so the
+    *          Kepler equation is solved only once per satellite """
+    tk = dtadjust_batch(t, eph.toe)
+    omge = rCST.OMGE
+
+    n = eph.n
+    M = eph.M0 + n * tk
+    E = kepler_batch(M, eph.e)
+
+    sinE, cosE = np.sin(E), np.cos(E)
+    sq1e2 = eph.sq1e2
+    nus = sq1e2 * sinE
+    nuc = cosE - eph.e
+    nue = 1.0 - eph.e * cosE
+    Ed = n / nue
+    phid = sq1e2 * Ed / nue
+    u = np.arctan2(nus, nuc) + eph.omg
+    r = eph.A * nue
+    rd = eph.A * eph.e * sinE * Ed
+    i = eph.i0 + eph.idot * tk
+    sin2u, cos2u = np.sin(2 * u), np.cos(2 * u)
+    ud = phid * (1.0 + 2.0 * (eph.cus * cos2u - eph.cuc * sin2u))
+    rd += 2.0 * phid * (eph.crs * cos2u - eph.crc * sin2u)
+    id = eph.idot + 2.0 * phid * (eph.cis * cos2u - eph.cic * sin2u)
+    u += eph.cus * sin2u + eph.cuc * cos2u
+    r += eph.crs * sin2u + eph.crc * cos2u
+    i += eph.cis * sin2u + eph.cic * cos2u
+    sinu, cosu = np.sin(u), np.cos(u)
+    x, y = r * cosu, r * sinu
+    xd = rd * cosu - y * ud
+    yd = rd * sinu + x * ud
+    sini, cosi = np.sin(i), np.cos(i)
+    O = eph.OMG0 + (eph.OMGd - omge) * tk - omge * eph.toes
+    Od = eph.OMGd - omge
+    sinO, cosO = np.sin(O), np.cos(O)
+
+    rs = np.empty((len(t), 6))
+    rs[:, 0] = x * cosO - y * cosi * sinO
+    rs[:, 1] = x * sinO + y * cosi * cosO
+    rs[:, 2] = y * sini
+    rs[:, 3] = xd * cosO - yd * cosi * sinO + y * sini * sinO * id - rs[:, 1] * Od
+    rs[:, 4] = xd * sinO + yd * cosi * cosO - y * sini * cosO * id + rs[:, 0] * Od
+    rs[:, 5] = yd * sini + y * cosi * id
+
+    dts = np.empty((len(t), 2))
+    tk = dtadjust_batch(t, eph.toc)
+    rel = 2 * eph.sqrtmuA * eph.e / rCST.CLIGHT ** 2
+    dts[:, 0] = eph.f0 + eph.f1 * tk + eph.f2 * tk ** 2 - rel * sinE
+    dts[:, 1] = eph.f1 + 2 * eph.f2 * tk - rel * cosE * Ed
+    return rs, dts
+
+
+def ephpos_batch(time, eph, mode=VEL_ANALYTIC):
+    """ array version of ephpos """
+    if mode == VEL_ANALYTIC:
+        return eph2posvel_batch(time, eph)
+    # velocity and drift by finite difference
+    tt = 1e-3  # delta t to calculate velocity
+    rs = np.zeros((len(time), 6))
+    dts = np.zeros((len(time), 2))
+
+    rs[:, 0:3], dts[:, 0] = eph2pos_batch(time, eph)
+    rs[:, 3:6], dts[:, 1] = eph2pos_batch(time + tt, eph)
+    rs[:, 3:6] = (rs[:, 3:6] - rs[:, 0:3]) / tt
+    dts[:, 1] = (dts[:, 1] - dts[:, 0]) / tt
+    return rs, dts
+
+
+def satposs_batch(sat, t, all_eph, mode=VEL_ANALYTIC, orbit=None):
+    """ satellite positions and clocks for arrays of observations ------------
+    * args     ndarray sat     I   satellite numbers, any shape
+    *          ndarray t       I   signal transmission times by satellite
+    *                              clock (gpst), same shape as sat
+    *          EphStore all_eph I  broadcast ephemerides (a plain list is
+    *                              wrapped into a store)
+    *          str  mode       I   velocity/drift evaluation, VEL_ANALYTIC
+    *                              (closed form) or VEL_DIFF (finite difference)
+    *          OrbitCache orbit I  optional interpolation cache built on
+    *                              all_eph, used where it covers t
+    * return : rs  (..., 6) satellite positions and velocities (ecef)
+    *          dts (..., 2) satellite clock bias and drift (s|s/s)
+    * notes  : sat and t may hold one epoch or a whole block of epochs
+    *          (e.g. shape (nepoch, nsat)), everything is solved in one pass.
+    *          elements without an ephemeris within MAXDTOE get zero rs
+    *          and dts """
+    sat = np.asarray(sat)
+    t = np.asarray(t, dtype=float)
+    shape = t.shape
+    sat, t = sat.ravel(), t.ravel()
+    rs = np.zeros((t.size, 6))
+    dts = np.zeros((t.size, 2))
+
+    if not isinstance(all_eph, EphStore):
+        all_eph = EphStore(all_eph)
+    idx = all_eph.select_index(sat, t)
+    has_eph = idx >= 0
+    if has_eph.any():
+        idx = idx[has_eph]
+        table = all_eph.table
+        tv = t[has_eph]
+        # satellite clock bias by broadcast ephemeris
+        tv = tv - eph2clk(tv, take_eph(table, idx, EPH_CLOCK))
+        # satellite position and clock at transmission time
+        if orbit is None:
+            rs[has_eph], dts[has_eph] = ephpos_batch(tv, take_eph(table, idx), mode)
+        else:
+            hit = orbit.covers(idx, tv)
+            rsv, dtsv = np.zeros((tv.size, 6)), np.zeros((tv.size, 2))
+            rsv[hit], dtsv[hit] = orbit.satpos(idx[hit], tv[hit])
+            if not hit.all():
+                rsv[~hit], dtsv[~hit] = ephpos_batch(tv[~hit], take_eph(table, idx[~hit]), mode)
+            rs[has_eph], dts[has_eph] = rsv, dtsv
+    return rs.reshape(shape + (6,)), dts.reshape(shape + (2,))
+
+
+def satposs(obs, all_eph, mode=VEL_ANALYTIC, orbit=None):
     """ satellite positions and clocks ----------------------------------------------
     * compute satellite positions, velocities and clocks
     * args     obs_t obs       I   observation data
     *          nav_t  nav      I   navigation data
+    *          str    mode     I   sat velocity/clock drift evaluation, VEL_ANALYTIC
+    *                              (default) or VEL_DIFF (finite difference)
+    *          OrbitCache orbit I  optional orbit interpolation cache
     *          double rs       O   satellite positions and velocities (ecef)
     *          double dts      O   satellite clocks
     *          double var      O   sat position and clock error variances (m^2)
@@ -140,23 +502,4 @@ def satposs(obs, all_eph):
     *          satellite clock does not include code bias correction (tgd or bgd)
     *          any pseudorange and broadcast ephemeris are always needed to get
     *          signal transmission time """
-    n = len(obs.sat)
-    rs = np.zeros((n, 6)) # pos, vel
-    dts = np.zeros((n, 2)) # clock bias, rate
-
-    for i in np.argsort(obs.sat):
-        sat = obs.sat[i]
-        pr = obs.P[i]
-        # transmission time by satellite clock
-        #t = timeadd(obs.t, -pr / rCST.CLIGHT)
-        #t = obs.t[i] + (-pr / rCST.CLIGHT)
-        t = obs.t[i]
-        eph = seleph(sat, all_eph)
-        if eph is None:
-            continue
-        # satellite clock bias by broadcast ephemeris
-        dt = ephclk(t, eph)
-        t = t + (-dt)
-        # satellite position and clock at transmission time
-        rs[i], dts[i] = satpos(t, eph)
-    return rs, dts
+    return satposs_batch(obs.sat, obs.t, all_eph, mode, orbit)
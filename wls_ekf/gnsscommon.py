@@ -53,6 +53,91 @@ class Obs():
         self.D = []
         self.SNR = []
 
+class ObsStore():
+    """ columnar observations of a whole session
+
+    every field of Obs is one typed array over all observations of the
+    session, epoch i owns rows offsets[i]:offsets[i+1] (CSR layout).
+    indexing or iterating the store gives per-epoch Obs whose fields are
+    zero-copy views into the columns.
+    """
+    FIELDS = {'sat': np.int32, 't': np.float64, 'week': np.int32, 'P': np.float64,
+              'corP': np.float64, 'D': np.float64, 'SNR': np.float64}
+
+    def __init__(self, offsets, **columns):
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        for name, dtype in self.FIELDS.items():
+            setattr(self, name, np.asarray(columns[name], dtype=dtype))
+
+    @classmethod
+    def from_epochs(cls, all_obs):
+        """ build the store from an iterable of Obs """
+        columns = {name: [] for name in cls.FIELDS}
+        offsets = [0]
+        for obs in all_obs:
+            for name in cls.FIELDS:
+                columns[name].extend(getattr(obs, name))
+            offsets.append(offsets[-1] + len(obs.sat))
+        return cls(offsets, **columns)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("epoch index out of range")
+        obs = Obs()
+        a, b = self.offsets[i], self.offsets[i + 1]
+        for name in self.FIELDS:
+            setattr(obs, name, getattr(self, name)[a:b])
+        return obs
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def slice(self, start, stop):
+        """ store of epochs [start, stop) sharing the columns (no copies) """
+        a, b = self.offsets[start], self.offsets[stop]
+        return ObsStore(self.offsets[start:stop + 1] - a,
+                        **{name: getattr(self, name)[a:b] for name in self.FIELDS})
+
+    @property
+    def nsat(self):
+        """ number of observations of each epoch """
+        return np.diff(self.offsets)
+
+    def epoch_of_row(self):
+        """ epoch number of every row of the columns """
+        return np.repeat(np.arange(len(self)), self.nsat)
+
+    def pack(self, epochs=None):
+        """ Obs with (nepoch, nsat) array fields for the given epochs (all
+        by default), padded with zeros (zero pseudorange marks an empty
+        slot) """
+        epochs = np.arange(len(self)) if epochs is None else np.asarray(epochs)
+        nsat = self.nsat[epochs]
+        ns = int(nsat.max()) if len(nsat) else 0
+        slot = np.arange(ns)
+        used = slot[None, :] < nsat[:, None]
+        rows = (self.offsets[epochs][:, None] + slot[None, :])[used]
+        packed = Obs()
+        for name, dtype in self.FIELDS.items():
+            a = np.zeros((len(epochs), ns), dtype=dtype)
+            a[used] = getattr(self, name)[rows]
+            setattr(packed, name, a)
+        return packed
+
+
+def pack_obs(all_obs):
+    """ pack epochs into one Obs whose fields are (nepoch, nsat) arrays,
+    padded with zeros (zero pseudorange marks an empty slot) """
+    if not isinstance(all_obs, ObsStore):
+        all_obs = ObsStore.from_epochs(all_obs)
+    return all_obs.pack()
+
 class Eph():
     """ class to define GPS/GAL/QZS/CMP ephemeris """
     sat = 0
@@ -108,6 +193,32 @@ def epoch2time(ep):
     return time
 
 
+# leap seconds (y,m,d,h,m,s,utc-gpst), newest first
+LEAPS = [[2017, 1, 1, 0, 0, 0, -18], [2015, 7, 1, 0, 0, 0, -17],
+         [2012, 7, 1, 0, 0, 0, -16], [2009, 1, 1, 0, 0, 0, -15],
+         [2006, 1, 1, 0, 0, 0, -14], [1999, 1, 1, 0, 0, 0, -13],
+         [1997, 7, 1, 0, 0, 0, -12], [1996, 1, 1, 0, 0, 0, -11],
+         [1994, 7, 1, 0, 0, 0, -10], [1993, 7, 1, 0, 0, 0, -9],
+         [1992, 7, 1, 0, 0, 0, -8], [1991, 1, 1, 0, 0, 0, -7],
+         [1990, 1, 1, 0, 0, 0, -6], [1988, 1, 1, 0, 0, 0, -5],
+         [1985, 7, 1, 0, 0, 0, -4], [1983, 7, 1, 0, 0, 0, -3],
+         [1982, 7, 1, 0, 0, 0, -2], [1981, 7, 1, 0, 0, 0, -1]]
+
+# precomputed epoch constants
+GPST0 = epoch2time(gpst0)   # gps time origin
+WEEK_SEC = 86400 * 7
+# month lengths of the 4 year cycles counted from 1970, cumulative days
+MDAY = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31, 31, 28, 31, 30, 31,
+        30, 31, 31, 30, 31, 30, 31, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31,
+        30, 31, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+MDAY_CUM = np.r_[0, np.cumsum(MDAY)]
+YDAY0 = [0, 365, 730, 1096]  # first day of each year of a cycle
+# leap second boundaries in utc and gps time (seconds since 1970), ascending
+LEAP_UTC = np.array([epoch2time(ep).time for ep in LEAPS[::-1]])
+LEAP_VAL = np.array([ep[6] for ep in LEAPS[::-1]])
+LEAP_GPST = LEAP_UTC - LEAP_VAL
+
+
 def gpst2utc(tgps, leaps_=-18):
     """ calculate UTC-time from gps-time """
     tutc = timeadd(tgps, leaps_)
@@ -138,28 +249,25 @@ def timediff(t1: gtime_t, t2: gtime_t):
 
 def gpst2time(week, tow):
     """ convert to time from gps-time """
-    t = epoch2time(gpst0)
+    t = gtime_t(GPST0.time)
     if tow < -1e9 or tow > 1e9:
         tow = 0.0
-    t.time += 86400*7*week+int(tow)
+    t.time += WEEK_SEC*week+int(tow)
     t.sec = tow-int(tow)
     return t
 
 
 def time2gpst(t: gtime_t):
     """ convert to gps-time from time """
-    t0 = epoch2time(gpst0)
-    sec = t.time-t0.time
-    week = int(sec/(86400*7))
-    tow = sec-week*86400*7+t.sec
+    sec = t.time-GPST0.time
+    week = int(sec/WEEK_SEC)
+    tow = sec-week*WEEK_SEC+t.sec
     return week, tow
 
 
 def time2epoch(t):
     """ convert time to epoch """
-    mday = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31, 31, 28, 31, 30, 31,
-            30, 31, 31, 30, 31, 30, 31, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31,
-            30, 31, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+    mday = MDAY
 
     days = int(t.time/86400)
     sec = int(t.time-days*86400)
@@ -180,11 +288,88 @@ def time2epoch(t):
 
 
 def time2doy(t):
-    """ convert time to epoch """
-    ep = time2epoch(t)
-    ep[1] = ep[2] = 1.0
-    ep[3] = ep[4] = ep[5] = 0.0
-    return timediff(t, epoch2time(ep))/86400+1
+    """ convert time to day of year """
+    days = int(t.time // 86400)
+    day = days % 1461
+    yday = day - max(d for d in YDAY0 if d <= day)
+    return (yday + (t.time - days * 86400 + t.sec) / 86400) + 1
+
+
+## array versions of the time conversions -----------------------------------
+# times are gtime_t whose fields are arrays: time (int64 seconds since 1970)
+# and sec (float fraction), in the same layout as the scalar gtime_t. gps
+# times are kept as (week, tow) arrays, as in the observation columns, which
+# keeps sub-nanosecond resolution of the time of week.
+
+def gpst2time_batch(week, tow):
+    """ array version of gpst2time """
+    tow = np.asarray(tow, dtype=float)
+    tow = np.where((tow < -1e9) | (tow > 1e9), 0.0, tow)
+    itow = np.trunc(tow)
+    return gtime_t(GPST0.time + WEEK_SEC * np.asarray(week, dtype=np.int64) + itow.astype(np.int64),
+                   tow - itow)
+
+
+def time2gpst_batch(t):
+    """ array version of time2gpst, return week, tow arrays """
+    sec = np.asarray(t.time, dtype=np.int64) - GPST0.time
+    week = np.trunc(sec / WEEK_SEC).astype(np.int64)
+    return week, (sec - week * WEEK_SEC) + np.asarray(t.sec, dtype=float)
+
+
+def timeadd_batch(t, sec):
+    """ array version of timeadd """
+    tsec = np.asarray(t.sec, dtype=float) + sec
+    tt = np.floor(tsec)
+    return gtime_t(np.asarray(t.time, dtype=np.int64) + tt.astype(np.int64), tsec - tt)
+
+
+def time2epoch_batch(t):
+    """ array version of time2epoch, return ep (..., 6) float array """
+    time = np.asarray(t.time, dtype=np.int64)
+    days = time // 86400
+    sec = time - days * 86400
+    day = days % 1461
+    mon = np.searchsorted(MDAY_CUM, day, side='right') - 1
+    ep = np.empty(time.shape + (6,))
+    ep[..., 0] = 1970 + days // 1461 * 4 + mon // 12
+    ep[..., 1] = mon % 12 + 1
+    ep[..., 2] = day - MDAY_CUM[mon] + 1
+    ep[..., 3] = sec // 3600
+    ep[..., 4] = sec % 3600 // 60
+    ep[..., 5] = sec % 60 + np.asarray(t.sec, dtype=float)
+    return ep
+
+
+def time2doy_batch(t):
+    """ array version of time2doy """
+    time = np.asarray(t.time, dtype=np.int64)
+    days = time // 86400
+    day = days % 1461
+    # days since jan 1 of the year within the 4 year cycle
+    yday = day - np.take(YDAY0, np.searchsorted(YDAY0, day, side='right') - 1)
+    return yday + ((time - days * 86400) + np.asarray(t.sec, dtype=float)) / 86400 + 1
+
+
+def leaps_gpst(tgps):
+    """ utc-gpst (s) at gps times tgps from the leap second table """
+    i = np.searchsorted(LEAP_GPST, np.asarray(tgps.time, dtype=np.int64), side='right') - 1
+    return np.where(i >= 0, LEAP_VAL[np.maximum(i, 0)], 0)
+
+
+def gpst2utc_batch(tgps, leaps_=None):
+    """ array version of gpst2utc, leaps_ None looks up the leap seconds
+    of each time in LEAPS """
+    return timeadd_batch(tgps, leaps_gpst(tgps) if leaps_ is None else leaps_)
+
+
+def utc2gpst_batch(tutc, leaps_=None):
+    """ array version of utc2gpst, leaps_ None looks up the leap seconds
+    of each time in LEAPS """
+    if leaps_ is None:
+        i = np.searchsorted(LEAP_UTC, np.asarray(tutc.time, dtype=np.int64), side='right') - 1
+        leaps_ = np.where(i >= 0, LEAP_VAL[np.maximum(i, 0)], 0)
+    return timeadd_batch(tutc, -leaps_)
 
 def geodist(rs, rr):
     """
@@ -228,6 +413,15 @@ def get_weight_based_elevation(el):
     return 1 / weight
 
 
+def get_weight_based_elevation_batch(el):
+    """ array version of get_weight_based_elevation """
+    a = 0.01
+    b = 0.01
+    with np.errstate(divide='ignore'):
+        weight = a ** 2 + (b / np.sin(el)) ** 2
+    return np.where(el <= 0.0, 0.0, 1 / weight)
+
+
 def get_weight_based_SNR(snr):
     """
     根据信噪比定权，a为经验值，在spp定位中a并不影响结果，因为a和信号频率有关
@@ -240,18 +434,16 @@ def xyz2enu(pos):
     """ return ECEF to ENU conversion matrix from LLH
         pos is LLH
     """
-    sp = sin(pos[0])
-    cp = cos(pos[0])
-    sl = sin(pos[1])
-    cl = cos(pos[1])
-    E = np.array([[-sl, cl, 0],
-                  [-sp*cl, -sp*sl, cp],
-                  [cp*cl, cp*sl, sp]])
-    return E
+    return xyz2enu_batch(pos)
 
 
 def ecef2pos(r):
     """  ECEF to LLH position conversion """
+    return ecef2pos_batch(r)
+
+
+def _ecef2pos_point(r):
+    """ ECEF to LLH conversion of one position with scalar arithmetic """
     pos = np.zeros(3)
     e2 = rCST.FE_WGS84*(2-rCST.FE_WGS84)
     r2 = r[0]**2+r[1]**2
@@ -269,6 +461,38 @@ def ecef2pos(r):
     return pos
 
 
+def ecef2pos_batch(r, maxiter=10):
+    """ ECEF to LLH position conversion of positions r (..., 3)
+    * the latitude iteration of ecef2pos runs on all positions at once until
+    * every position converged (1e-4 m) or maxiter; positions that converged
+    * earlier take the extra iterations, which only refine them. a single
+    * position is converted with scalar arithmetic, which is cheaper than
+    * array operations on one element """
+    r = np.asarray(r, dtype=float)
+    if r.size == 3:
+        return _ecef2pos_point(r.ravel()).reshape(r.shape)
+    e2 = rCST.FE_WGS84*(2-rCST.FE_WGS84)
+    r2 = r[..., 0]**2+r[..., 1]**2
+    # no iteration in the equatorial plane (and at the earth center)
+    flat = np.abs(r[..., 2]) < 1e-4
+    z = r[..., 2]
+    v = rCST.RE_WGS84
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(maxiter):
+            sinp = z / np.sqrt(r2+z**2)
+            v = rCST.RE_WGS84 / np.sqrt(1 - e2 * sinp**2)
+            zk, z = z, r[..., 2] + v * e2 * sinp
+            if not np.any(np.abs(z - zk) >= 1e-4):
+                break
+        z = np.where(flat, r[..., 2], z)
+        v = np.where(flat, rCST.RE_WGS84, v)
+        pos = np.empty(r.shape)
+        pos[..., 0] = np.where(r2 > 1e-12, np.arctan(z / np.sqrt(r2)), np.pi / 2 * np.sign(r[..., 2]))
+    pos[..., 1] = np.where(r2 > 1e-12, np.arctan2(r[..., 1], r[..., 0]), 0)
+    pos[..., 2] = np.sqrt(r2 + z**2) - v
+    return pos
+
+
 def pos2ecef(pos, isdeg: bool = False):
     """ LLH (rad/deg) to ECEF position conversion  """
     if isdeg:
@@ -303,14 +527,41 @@ def enu2ecef(pos, e):
 
 def satazel(pos, e):
     """ calculate az/el from LOS vector in ECEF (e) """
-    if pos[2] > -rCST.RE_WGS84 + 1:
-        enu = ecef2enu(pos, e)
-        az = atan2(enu[0], enu[1]) if np.dot(enu, enu) > 1e-12 else 0
-        az = az if az > 0 else az + 2 * np.pi
-        el = asin(enu[2])
-        return [az, el]
-    else:
-        return [0, np.pi / 2]
+    az, el = satazel_batch(pos, np.asarray(e, dtype=float)[None])
+    return [float(az[0]), float(el[0])]
+
+def xyz2enu_batch(pos):
+    """ ECEF to ENU conversion matrices for LLH positions pos (..., 3) """
+    pos = np.asarray(pos)
+    sp, cp = np.sin(pos[..., 0]), np.cos(pos[..., 0])
+    sl, cl = np.sin(pos[..., 1]), np.cos(pos[..., 1])
+    E = np.empty(pos.shape[:-1] + (3, 3))
+    E[..., 0, 0], E[..., 0, 1], E[..., 0, 2] = -sl, cl, 0
+    E[..., 1, 0], E[..., 1, 1], E[..., 1, 2] = -sp*cl, -sp*sl, cp
+    E[..., 2, 0], E[..., 2, 1], E[..., 2, 2] = cp*cl, cp*sl, sp
+    return E
+
+def satazel_batch(pos, e):
+    """ calculate az/el from LOS vectors in ECEF
+    * pos (..., 3) LLH of the receiver(s), e (..., n, 3) LOS vectors;
+    * one rotation per receiver is applied to all of its LOS vectors """
+    enu = e @ np.swapaxes(xyz2enu_batch(pos), -1, -2)
+    az = np.where(np.sum(enu * enu, axis=-1) > 1e-12,
+                  np.arctan2(enu[..., 0], enu[..., 1]), 0)
+    az = np.where(az > 0, az, az + 2 * np.pi)
+    el = np.arcsin(enu[..., 2])
+    # no azimuth/elevation for a receiver at the earth center
+    low = (np.asarray(pos)[..., 2] <= -rCST.RE_WGS84 + 1)[..., None]
+    return np.where(low, 0, az), np.where(low, np.pi / 2, el)
+
+def cov2dop(Q, pos):
+    """ dilution of precision (gdop, pdop, hdop, vdop) from the covariance
+    of a position/clock solution, Q[0:4, 0:4] is x, y, z and clock
+    * notes  : with weighted measurements these are weighted DOPs """
+    E = xyz2enu(pos)
+    Qenu = E @ Q[0:3, 0:3] @ E.T
+    return np.sqrt(np.maximum([np.trace(Q[0:4, 0:4]), np.trace(Q[0:3, 0:3]),
+                               Qenu[0, 0] + Qenu[1, 1], Qenu[2, 2]], 0.0))
 
 def interpc(coef, lat):
     """ linear interpolation (lat step=15) """
@@ -321,3 +572,11 @@ def interpc(coef, lat):
         return coef[:, 4]
     d = lat / 15.0 - i
     return coef[:, i-1] * (1.0 - d) + coef[:, i] * d
+
+def interpc_batch(coef, lat):
+    """ array version of interpc, returns coef.shape[0] x lat.shape """
+    x = np.asarray(lat) / 15.0
+    i = x.astype(int)
+    d = np.where(i < 1, 0.0, np.where(i > 4, 1.0, x - i))
+    i = np.clip(i, 1, 4)
+    return coef[:, i-1] * (1.0 - d) + coef[:, i] * d
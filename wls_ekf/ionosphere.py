@@ -5,7 +5,6 @@ url: https://github.com/rtklibexplorer/rtklib-py
 
 """
 
-from math import sin, cos
 import numpy as np
 from gnsscommon import time2gpst, rCST
 
@@ -19,26 +18,26 @@ ion_default = np.array([ # 2021/10/14
 
 def ionmodel(t, pos, az, el, ion=ion_default):
     """ klobuchar model of ionosphere delay estimation """
+    return float(ionmodel_batch(t, pos, az, el, ion))
+
+
+def ionmodel_batch(t, pos, az, el, ion=ion_default):
+    """ klobuchar model for arrays of azimuth and elevation
+    * t, pos[0] and pos[1] may be arrays that broadcast against az/el """
     psi = 0.0137 / (el / np.pi + 0.11) - 0.022
-    phi = pos[0] / np.pi + psi * cos(az)
-    phi = np.max((-0.416, np.min((0.416, phi))))
-    lam = pos[1]/np.pi + psi * sin(az) / cos(phi * np.pi)
-    phi += 0.064 * cos((lam - 1.617) * np.pi)
-    #_, tow = time2gpst(t)
+    phi = pos[0] / np.pi + psi * np.cos(az)
+    phi = np.clip(phi, -0.416, 0.416)
+    lam = pos[1]/np.pi + psi * np.sin(az) / np.cos(phi * np.pi)
+    phi += 0.064 * np.cos((lam - 1.617) * np.pi)
     tow = t
     tt = 43200.0 * lam + tow  # local time
     tt -= np.floor(tt / 86400) * 86400
     f = 1.0 + 16.0 * np.power(0.53 - el/np.pi, 3.0)  # slant factor
 
-    h = [1, phi, phi**2, phi**3]
-    amp = np.dot(h, ion[0, :])
-    per = np.dot(h, ion[1, :])
-    amp = max(amp, 0)
-    per = max(per, 72000.0)
+    h = np.stack([np.ones_like(phi), phi, phi**2, phi**3], axis=-1)
+    amp = np.maximum(h @ ion[0, :], 0)
+    per = np.maximum(h @ ion[1, :], 72000.0)
     x = 2.0 * np.pi * (tt - 50400.0) / per
-    if np.abs(x) < 1.57:
-        v = 5e-9 + amp * (1.0 + x * x * (-0.5 + x * x / 24.0))
-    else:
-        v = 5e-9
+    v = np.where(np.abs(x) < 1.57, 5e-9 + amp * (1.0 + x * x * (-0.5 + x * x / 24.0)), 5e-9)
     diono = rCST.CLIGHT * f * v
     return diono
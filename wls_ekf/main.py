@@ -1,52 +1,189 @@
+import os
+import sys
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from wls import *
 from ekf import *
+from resultio import *
+from telemetry import *
 
-def output_data_to_file(data, filname):
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OBS_FILE = 'obsData.mat'
+EPH_FILE = 'ephData.mat'
+METHODS = ['wls', 'ekf']
+
+def output_data_to_file(data, filname, fmt=None):
     """
-    output the pos and vel result to file
+    output the pos and vel result to file, data may be a generator whose
+    rows are written as they are produced (see ResultWriter, the format
+    follows the extension unless fmt is given), return the number of rows
     """
-    out_str = ""
-    for i in range(len(data)):
-        for j in range(len(data[i])):
-            out_str += "%.3f  " % (data[i][j])
-        out_str += "\n"
-    with open(filname, 'w') as fopen:
-        fopen.writelines(out_str)
+    with ResultWriter(filname, fmt) as writer:
+        return writer.write_rows(data)
 
-def wls_method(obs_filename, eph_filename, output_filename):
+def wls_method(obs_filename, eph_filename, output_filename, fde=False, orbit_cache_dir=None):
     """
     wls
     """
-    out = WLS_pos_vel_estimation(obs_filename,eph_filename)
-    output_data_to_file(out, output_filename)
+    out = WLS_pos_vel_stream(obs_filename, eph_filename, fde, orbit_cache_dir)
+    return output_data_to_file(out, output_filename)
 
-def ekf_method(obs_filename, eph_filename, output_filename):
+def ekf_method(obs_filename, eph_filename, output_filename, mode=EKF_JOSEPH, fde=False,
+               orbit_cache_dir=None):
     """
     EKF
     """
-    out = EKF_pos_vel_estimation(obs_filename, eph_filename)
-    output_data_to_file(out, output_filename)
+    out = EKF_pos_vel_stream(obs_filename, eph_filename, mode, fde, orbit_cache_dir)
+    return output_data_to_file(out, output_filename)
 
-def main():
+def find_datasets(patterns, manifest=None):
     """
-    outputformat: tow,x,y,z,vx,vy,vz
+    dataset directories (containing obsData.mat and ephData.mat, or only
+    their binary caches as written by synthetic.py) from glob
+    patterns and an optional manifest file with one pattern per line
+    """
+    patterns = list(patterns)
+    if manifest:
+        with open(manifest) as f:
+            base = os.path.dirname(os.path.abspath(manifest))
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    patterns.append(os.path.join(base, line))
+    datasets = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            path = os.path.normpath(path)
+            if path in datasets:
+                continue
+            if not (dataset_file_exists(os.path.join(path, OBS_FILE)) and
+                    dataset_file_exists(os.path.join(path, EPH_FILE))):
+                print("skip %s: no %s/%s" % (path, OBS_FILE, EPH_FILE), file=sys.stderr)
+                continue
+            datasets.append(path)
+    return datasets
+
+def load_dataset(path):
+    """
+    parse the .mat files of a dataset into their binary cache (see
+    read_mat) if it is missing or out of date, the jobs of all methods then
+    memory map the same cache. the observations are written block by block
+    (see build_obs_cache), an existing cache is only checked
     """
-    # Opensky
-    opensky_obs_filename = r".\data\Opensky\obsData.mat"
-    opensky_eph_filename = r".\data\Opensky\ephData.mat"
-    opensky_output_filename_wls = r".\result\Opensky\wls.txt"
-    opensky_output_filename_ekf = r".\result\Opensky\ekf.txt"
-    wls_method(opensky_obs_filename, opensky_eph_filename, opensky_output_filename_wls)
-    ekf_method(opensky_obs_filename, opensky_eph_filename, opensky_output_filename_ekf)
-    """
-    # Urban doppler need to be corrected to -doppler
-    urban_obs_filename = r".\data\Urban\obsData.mat"
-    urban_eph_filename = r".\data\Urban\ephData.mat"
-    urban_output_filename_wls = r".\result\Urban\wls.txt"
-    urban_output_filename_ekf = r".\result\Urban\ekf.txt"
-    wls_method(urban_obs_filename, urban_eph_filename, urban_output_filename_wls)
-    ekf_method(urban_obs_filename, urban_eph_filename, urban_output_filename_ekf)
+    obs_filename = os.path.join(path, OBS_FILE)
+    eph_filename = os.path.join(path, EPH_FILE)
+    if load_cache(obs_filename) is None:
+        build_obs_cache(obs_filename)
+    if load_cache(eph_filename) is None:
+        read_eph_mat(eph_filename)
+    return path
+
+def run_job(path, method, out_dir, ekf_mode=EKF_JOSEPH, fmt='txt', telemetry=False, fde=False,
+            orbit_cache_dir=None):
+    """
+    run one method on one dataset, return (path, method, epochs, seconds,
+    telemetry summary). with telemetry the epoch records go to
+    <method>_telemetry.jsonl next to the result (see telemetry.py),
+    otherwise the summary is None. fde enables the fault detection and
+    exclusion of the estimators, orbit_cache_dir the orbit fits persisted
+    there (see OrbitCache)
+    """
+    result_dir = os.path.join(out_dir, os.path.basename(path))
+    os.makedirs(result_dir, exist_ok=True)
+    obs_filename = os.path.join(path, OBS_FILE)
+    eph_filename = os.path.join(path, EPH_FILE)
+    output_filename = os.path.join(result_dir, method + '.' + fmt)
+    if telemetry:
+        TELEMETRY.start(os.path.join(result_dir, method + '_telemetry.jsonl'), method)
+    t0 = time.perf_counter()
+    try:
+        if method == 'wls':
+            n = wls_method(obs_filename, eph_filename, output_filename, fde, orbit_cache_dir)
+        else:
+            n = ekf_method(obs_filename, eph_filename, output_filename, ekf_mode, fde,
+                           orbit_cache_dir)
+    finally:
+        summary = TELEMETRY.stop() if telemetry else None
+    return path, method, n, time.perf_counter() - t0, summary
+
+def run_jobs(datasets, methods, out_dir, workers=1, ekf_mode=EKF_JOSEPH, fmt='txt',
+             telemetry=False, fde=False, orbit_cache_dir=None):
     """
+    run every method on every dataset, on a process pool when workers > 1,
+    and print the throughput of each job (and its telemetry summary) as it
+    finishes
+    """
+    jobs = [(path, method, out_dir, ekf_mode, fmt, telemetry, fde, orbit_cache_dir)
+            for path in datasets for method in methods]
+    if workers <= 1:
+        for path in datasets:
+            load_dataset(path)
+        results = []
+        for job in jobs:
+            results.append(run_job(*job))
+            print_job(*results[-1])
+        return results
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # parse each dataset once before its jobs are started
+        list(pool.map(load_dataset, datasets))
+        futures = [pool.submit(run_job, *job) for job in jobs]
+        for future in as_completed(futures):
+            results.append(future.result())
+            print_job(*results[-1])
+    return results
+
+def print_job(path, method, n, sec, summary=None):
+    print("%-30s %-4s %6d epochs %8.2f s %9.1f epochs/s"
+          % (os.path.basename(path), method, n, sec, n / sec if sec > 0 else 0.0))
+    if summary is not None:
+        print(summary_table(summary))
+
+def main(argv=None):
+    """
+    outputformat: tow,x,y,z,vx,vy,vz
+
+    python main.py [dataset dir or glob ...] [-f manifest] [-m wls ekf] [-j N]
+    results go to <out>/<dataset name>/<method>.<format>, the default dataset is
+    data/Opensky
+    """
+    parser = argparse.ArgumentParser(description="WLS/EKF position and velocity "
+                                     "from FGI-GSRx obsData.mat/ephData.mat exports")
+    parser.add_argument('datasets', nargs='*', help="dataset directories or glob patterns")
+    parser.add_argument('-f', '--manifest', help="file with one dataset directory or glob per line")
+    parser.add_argument('-m', '--methods', nargs='+', choices=METHODS, default=METHODS)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes")
+    parser.add_argument('-o', '--out', default=os.path.join(BASE_DIR, 'result'),
+                        help="output directory")
+    parser.add_argument('--ekf-mode', default=EKF_JOSEPH,
+                        choices=[EKF_JOSEPH, EKF_SEQUENTIAL, EKF_SQRT, EKF_ITERATED])
+    parser.add_argument('--format', default='txt', choices=RESULT_FORMATS,
+                        help="result file format, npy can be memory-mapped")
+    parser.add_argument('--telemetry', action='store_true',
+                        help="write per-epoch stage times, iterations and rejections to "
+                        "<method>_telemetry.jsonl and print a summary")
+    parser.add_argument('--fde', action='store_true',
+                        help="RAIM fault detection and exclusion of faulty satellites")
+    parser.add_argument('--orbit-cache', metavar='DIR',
+                        help="interpolate orbits from Chebyshev fits kept in DIR (built on "
+                        "first use), saves Kepler solutions on high-rate data")
+    args = parser.parse_args(argv)
+
+    patterns = args.datasets
+    if not patterns and not args.manifest:
+        patterns = [os.path.join(BASE_DIR, 'data', 'Opensky')]
+    datasets = find_datasets(patterns, args.manifest)
+    if not datasets:
+        parser.error("no dataset found")
+    t0 = time.perf_counter()
+    results = run_jobs(datasets, args.methods, args.out, args.jobs, args.ekf_mode,
+                       args.format, args.telemetry, args.fde, args.orbit_cache)
+    nepoch = sum(r[2] for r in results)
+    sec = time.perf_counter() - t0
+    print("%d jobs, %d epochs in %.2f s (%.1f epochs/s)" % (len(results), nepoch, sec, nepoch / sec))
 
 if __name__ == '__main__':
     main()
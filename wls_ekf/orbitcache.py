@@ -0,0 +1,189 @@
+## Chebyshev interpolation cache of broadcast orbits for high-rate sessions
+
+import os
+import numpy as np
+from numpy.polynomial import chebyshev
+from gnsscommon import *
+from ephemeris import *
+
+ORBIT_DEG = 10          # degree of the Chebyshev fit per segment
+ORBIT_SEG_LEN = 1800.0  # initial segment length (s)
+ORBIT_TOL_POS = 1e-3    # max allowed position interpolation error (m)
+ORBIT_TOL_CLK = 1e-13   # max allowed clock interpolation error (s)
+ORBIT_MAX_SPLIT = 6     # max times a segment length is halved to meet tol
+
+
+def cheb_nodes(deg):
+    """ Chebyshev points of the first kind on [-1, 1] """
+    return np.cos(np.pi * (np.arange(deg + 1) + 0.5) / (deg + 1))
+
+
+def cheb_basis(tau, deg):
+    """ Chebyshev polynomials T_k(tau) and dT_k/dtau, k = 0..deg
+    * tau (n,) in [-1, 1], return T, dT both (n, deg+1)
+    * with tau = cos(theta): T_k = cos(k theta), dT_k = k sin(k theta) /
+    * sin(theta), which is k^2 (+-1)^(k+1) at the end points. one array
+    * expression instead of a recursion over k (epochs have few rows) """
+    k = np.arange(deg + 1)
+    tau = np.clip(tau, -1.0, 1.0)[:, None]
+    theta = np.arccos(tau)
+    T = np.cos(k * theta)
+    s = np.sin(theta)
+    edge = s < 1e-8
+    dT = np.where(edge, k ** 2 * np.sign(tau) ** (k + 1),
+                  k * np.sin(k * theta) / np.where(edge, 1.0, s))
+    return T, dT
+
+
+def cheb_eval(coef, tau):
+    """ evaluate Chebyshev series with per-element coefficients
+    * coef (n, deg+1, m), tau (n,) in [-1, 1], return (n, m) """
+    T, _ = cheb_basis(tau, coef.shape[1] - 1)
+    return np.einsum('nk,nkm->nm', T, coef)
+
+
+def fit_orbit(eph, t0, t1, deg=ORBIT_DEG, seg_len=ORBIT_SEG_LEN,
+              tol_pos=ORBIT_TOL_POS, tol_clk=ORBIT_TOL_CLK):
+    """ fit position and clock bias of one ephemeris over [t0, t1] --------
+    * args   : Eph eph          I   ephemeris (array fields of length 1)
+    *          float t0, t1     I   time span to cover (gpst)
+    * return : seg_len, coef (nseg, deg+1, 4), max position and clock error
+    * notes  : the fit interpolates eph2posvel_batch at Chebyshev nodes and
+    *          is verified at points between the nodes; the segment length
+    *          is halved until the errors are below tol_pos and tol_clk """
+    x = cheb_nodes(deg)
+    # verification points: midpoints between nodes and the segment edges
+    xv = np.r_[-1.0, (x[1:] + x[:-1]) / 2.0, 1.0]
+    for _ in range(ORBIT_MAX_SPLIT + 1):
+        nseg = max(int(np.ceil((t1 - t0) / seg_len)), 1)
+        a = t0 + seg_len * np.arange(nseg)
+        t = (a[:, None] + (x[None, :] + 1.0) / 2.0 * seg_len).ravel()
+        rs, dts = eph2posvel_batch(t, take_eph(eph, np.zeros(t.size, dtype=int)))
+        y = np.c_[rs[:, :3], dts[:, 0]].reshape(nseg, deg + 1, 4)
+        # one least squares fit per segment, all components at once
+        coef = chebyshev.chebfit(x, y.transpose(1, 0, 2).reshape(deg + 1, -1), deg)
+        coef = coef.reshape(deg + 1, nseg, 4).transpose(1, 0, 2)
+
+        tv = (a[:, None] + (xv[None, :] + 1.0) / 2.0 * seg_len).ravel()
+        rs, dts = eph2posvel_batch(tv, take_eph(eph, np.zeros(tv.size, dtype=int)))
+        yv = cheb_eval(np.repeat(coef, len(xv), axis=0), np.tile(xv, nseg))
+        err_pos = np.max(np.linalg.norm(yv[:, :3] - rs[:, :3], axis=1))
+        err_clk = np.max(np.abs(yv[:, 3] - dts[:, 0]))
+        if err_pos <= tol_pos and err_clk <= tol_clk:
+            return seg_len, coef, err_pos, err_clk
+        seg_len /= 2.0
+    raise ValueError("orbit fit of sat %d does not reach tolerance (%.3e m, %.3e s)"
+                     % (eph.sat[0], err_pos, err_clk))
+
+
+class OrbitCache():
+    """ per-ephemeris Chebyshev fits of satellite position and clock
+
+    The cache is built for the records of an EphStore, each over its
+    validity window toe +- MAXDTOE (or over a given session span t0..t1).
+    Queries find their segment by integer division and evaluate a fixed
+    degree series, so the cost per satellite does not depend on Kepler
+    iterations. Fits are verified against eph2posvel_batch when built and
+    can be persisted to cache_dir, one file per ephemeris keyed by PRN,
+    IODE and toe, so reprocessing the same dataset skips orbit computation.
+    The fits pay off where satellites are evaluated epoch by epoch (stream
+    paths, realtime service): a whole session is one satposs_batch pass,
+    which is already cheaper than loading the fits.
+    """
+
+    def __init__(self, all_eph, t0=None, t1=None, cache_dir=None, deg=ORBIT_DEG,
+                 tol_pos=ORBIT_TOL_POS, tol_clk=ORBIT_TOL_CLK):
+        if not isinstance(all_eph, EphStore):
+            all_eph = EphStore(all_eph)
+        self.all_eph = all_eph
+        self.deg = deg
+        n = len(all_eph)
+        self.t0 = np.zeros(n)
+        self.seg_len = np.ones(n)
+        self.nseg = np.zeros(n, dtype=int)
+        self.err_pos = np.zeros(n)
+        self.err_clk = np.zeros(n)
+        coefs = []
+        table = all_eph.table
+        for k, eph in enumerate(all_eph):
+            if t0 is None:
+                span = (eph.toe - MAXDTOE, eph.toe + MAXDTOE)
+            else:
+                span = (t0, t1)
+            fit = self._load(cache_dir, eph, *span) if cache_dir else None
+            if fit is None:
+                fit = (span[0],) + fit_orbit(take_eph(table, np.array([k])), *span, deg,
+                                             tol_pos=tol_pos, tol_clk=tol_clk)
+                if cache_dir:
+                    self._save(cache_dir, eph, fit)
+            self.t0[k], self.seg_len[k], coef, self.err_pos[k], self.err_clk[k] = fit
+            self.nseg[k] = len(coef)
+            coefs.append(coef)
+        nmax = max([len(c) for c in coefs], default=0)
+        self.coef = np.zeros((n, nmax, deg + 1, 4))
+        for k, coef in enumerate(coefs):
+            self.coef[k, :len(coef)] = coef
+
+    @staticmethod
+    def cache_file(cache_dir, eph):
+        return os.path.join(cache_dir, "orbit_G%02d_%d_%d.npz"
+                            % (int(eph.sat), int(eph.iode), int(eph.toe)))
+
+    def _load(self, cache_dir, eph, t0, t1):
+        filename = self.cache_file(cache_dir, eph)
+        try:
+            with np.load(filename) as data:
+                coef = data['coef']
+                seg_len = float(data['seg_len'])
+                t0_fit = float(data['t0'])
+                err_pos, err_clk = float(data['err_pos']), float(data['err_clk'])
+        except (OSError, ValueError, KeyError):
+            return None
+        # reuse only if the stored fit covers the requested span
+        if (coef.shape[1] != self.deg + 1 or t0_fit > t0
+                or t0_fit + seg_len * len(coef) < t1):
+            return None
+        return t0_fit, seg_len, coef, err_pos, err_clk
+
+    def _save(self, cache_dir, eph, fit):
+        os.makedirs(cache_dir, exist_ok=True)
+        t0, seg_len, coef, err_pos, err_clk = fit
+        # written aside and renamed, parallel jobs may share cache_dir
+        filename = self.cache_file(cache_dir, eph)
+        tmp = filename + '.tmp%d' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.savez(f, t0=t0, seg_len=seg_len, coef=coef, err_pos=err_pos, err_clk=err_clk)
+        os.replace(tmp, filename)
+
+    def covers(self, idx, t):
+        """ True where row idx has a fit that covers time t """
+        k = np.floor((t - self.t0[idx]) / self.seg_len[idx])
+        return (idx >= 0) & (k >= 0) & (k < self.nseg[idx])
+
+    def satpos(self, idx, t):
+        """ interpolated satellite positions and clocks ---------------------
+        * args   : ndarray idx      I   ephemeris rows of all_eph, shape (n,)
+        *          ndarray t        I   time (gpst), shape (n,), must be
+        *                               covered by the fit (see covers)
+        * return : rs (n,6) positions and velocities, dts (n,2) clocks """
+        seg_len = self.seg_len[idx]
+        k = np.floor((t - self.t0[idx]) / seg_len).astype(int)
+        tau = 2.0 * (t - self.t0[idx] - k * seg_len) / seg_len - 1.0
+        T, dT = cheb_basis(tau, self.deg)
+        # series and its time derivative (velocity, clock drift) in one product
+        B = np.empty((len(t), 2, self.deg + 1))
+        B[:, 0] = T
+        B[:, 1] = dT * (2.0 / seg_len)[:, None]
+        y = B @ self.coef[idx, k]
+        rs = np.concatenate([y[:, 0, :3], y[:, 1, :3]], axis=1)
+        dts = y[:, :, 3]
+        return rs, dts
+
+
+def orbit_cache_for_obs(all_obs, all_eph, cache_dir=None, margin=60.0):
+    """ build an OrbitCache covering the transmit times of all_obs """
+    if isinstance(all_obs, ObsStore):
+        t = all_obs.t
+    else:
+        t = np.concatenate([np.asarray(obs.t, dtype=float) for obs in all_obs])
+    return OrbitCache(all_eph, t.min() - margin, t.max() + margin, cache_dir)
@@ -20,11 +20,7 @@ def calculate_average(xyz):
     return x_mean, y_mean, z_mean
 
 def calculate_neu(x_mean,y_mean,z_mean,xyz):
-    neu = []
-    for i in range(len(xyz)):
-        n, e, u = xyz2neu(x_mean, y_mean, z_mean, xyz[i][0], xyz[i][1], xyz[i][2])
-        neu.append([n,e,u])
-    return neu
+    return xyz2neu_batch([x_mean, y_mean, z_mean], np.array(xyz))
 
 
 def plot_lat_lon(i,neu, size, title):
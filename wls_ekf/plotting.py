@@ -0,0 +1,207 @@
+## headless figures of result files with decimation for long sessions
+
+import os
+import sys
+import json
+import glob
+import warnings
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from pycoord import *
+from resultio import *
+
+PLOT_WIDTH = 2000       # samples kept per line, about one per pixel column
+PLOT_GRID = 800         # cells per axis of the lat/lon scatter decimation
+PLOT_DPI = 100
+REF_FILE = 'reference.json'  # {"lat": .., "lon": ..} in degree next to the result files
+
+
+def minmax_decimate(y, nbuckets=PLOT_WIDTH // 2):
+    """ indices of the min and max of y (n,) or of any column of y (n, m)
+    in each of nbuckets equal buckets, in time order; spikes survive the
+    decimation, so the drawn envelope equals that of all samples """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= 2 * nbuckets:
+        return np.arange(n)
+    y = y.reshape(n, -1)
+    size = -(-n // nbuckets)
+    pad = size * nbuckets - n
+    yb = np.pad(y, ((0, pad), (0, 0)), mode='edge').reshape(nbuckets, size, -1)
+    start = (np.arange(nbuckets) * size)[:, None]
+    idx = np.concatenate([start + yb.argmin(axis=1), start + yb.argmax(axis=1)], axis=1)
+    return np.unique(np.minimum(idx, n - 1))
+
+
+def lttb(x, y, nout=PLOT_WIDTH):
+    """ largest triangle three buckets: indices of nout samples of (x, y)
+    that keep the visual shape of the line """
+    n = len(x)
+    if nout >= n or nout < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, nout - 1).astype(int)
+    idx = np.empty(nout, dtype=int)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(nout - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # average of the next bucket (last point for the final bucket)
+        nlo, nhi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+
+def grid_decimate(x, y, ncell=PLOT_GRID):
+    """ indices of one sample per occupied cell of an ncell x ncell grid
+    over the extent of (x, y), for scatter plots """
+    n = len(x)
+    if n <= ncell:
+        return np.arange(n)
+    def cell(v):
+        v = np.asarray(v, dtype=float)
+        span = v.max() - v.min()
+        return np.zeros(n, dtype=np.int64) if span == 0 else \
+            np.minimum(((v - v.min()) / span * ncell).astype(np.int64), ncell - 1)
+    _, idx = np.unique(cell(x) * ncell + cell(y), return_index=True)
+    return np.sort(idx)
+
+
+def load_result(filename):
+    """ result rows of filename, a .npy next to a text result is used
+    instead when it is not older, since it is memory-mapped instead of
+    parsed. an empty result gives no rows """
+    npy = os.path.splitext(filename)[0] + '.npy'
+    if npy != filename and os.path.exists(npy) and \
+            os.path.getmtime(npy) >= os.path.getmtime(filename):
+        filename = npy
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', 'loadtxt: input contained no data')
+        return read_result(filename)
+
+
+def load_reference(filename):
+    """ reference (lat, lon) in degree of a result file from the REF_FILE
+    in its directory, None if there is none """
+    path = os.path.join(os.path.dirname(os.path.abspath(filename)), REF_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        ref = json.load(f)
+    return float(ref['lat']), float(ref['lon'])
+
+
+def plot_result(filename, out_dir, name=None, ref=None):
+    """ lat/lon, NEU and velocity figures of one result file, written to
+    out_dir as <name>_lat_lon.png, <name>_neu.png and <name>_vel.png.
+    name defaults to <dataset>_<method> from the result path, ref is the
+    reference (lat, lon) drawn on the lat/lon figure (from load_reference
+    by default, else the session mean). returns the figure files, none for
+    an empty result
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    dataset = os.path.basename(os.path.dirname(os.path.abspath(filename)))
+    method = os.path.splitext(os.path.basename(filename))[0]
+    name = name or "%s_%s" % (dataset, method)
+    data = load_result(filename)
+    if len(data) == 0:
+        return []
+    t = data[:, 0] - data[0, 0]
+    xyz = np.asarray(data[:, 1:4])
+    vel = data[:, 4:7]
+    os.makedirs(out_dir, exist_ok=True)
+    files = []
+
+    # lat/lon scatter
+    blh = xyz2blh_batch(xyz)
+    ref = ref or load_reference(filename)
+    if ref is None:
+        ref, ref_label = xyz2blh_batch(xyz.mean(axis=0))[:2], 'Session Mean'
+    else:
+        ref_label = 'Reference'
+    k = grid_decimate(blh[:, 1], blh[:, 0])
+    fig, ax = plt.subplots(figsize=(8, 8))
+    ax.scatter(blh[k, 1], blh[k, 0], s=4, color='blue', label='Data Points')
+    ax.scatter(ref[1], ref[0], label=ref_label, color='red', marker='^', s=200)
+    ax.set_title("%s %s Positioning Result" % (dataset, method.upper()))
+    ax.set_xlabel('Longitude (degree)')
+    ax.set_ylabel('Latitude (degree)')
+    ax.ticklabel_format(useOffset=False)
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.grid(True)
+    ax.legend()
+    files.append(_save(plt, fig, out_dir, name + '_lat_lon.png'))
+
+    # NEU about the median position, robust to the first epochs
+    neu = xyz2neu_batch(np.median(xyz, axis=0), xyz)
+    files.append(_plot_lines(plt, t, neu, ['N', 'E', 'U'], 'Coordinate (m)',
+                             "%s %s NEU Result" % (dataset, method.upper()),
+                             out_dir, name + '_neu.png'))
+    files.append(_plot_lines(plt, t, vel, ['X', 'Y', 'Z'], 'Velocity (m/s)',
+                             "%s %s XYZ Velocity" % (dataset, method.upper()),
+                             out_dir, name + '_vel.png'))
+    return files
+
+
+def _plot_lines(plt, t, y, labels, ylabel, title, out_dir, filename):
+    k = minmax_decimate(y)
+    fig, ax = plt.subplots(figsize=(PLOT_WIDTH / PLOT_DPI / 2, 6))
+    for i, (label, color) in enumerate(zip(labels, 'rgb')):
+        ax.plot(t[k], y[k, i], linestyle='-', linewidth=0.8, color=color, label=label)
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel(ylabel)
+    ax.set_title(title)
+    ax.grid(True)
+    ax.legend()
+    return _save(plt, fig, out_dir, filename)
+
+
+def _save(plt, fig, out_dir, filename):
+    path = os.path.join(out_dir, filename)
+    fig.savefig(path, dpi=PLOT_DPI, bbox_inches='tight')
+    plt.close(fig)
+    return path
+
+
+def plot_results(filenames, out_dir, workers=1, ref=None):
+    """ figures of many result files, on a process pool when workers > 1 """
+    if workers <= 1:
+        return [plot_result(f, out_dir, ref=ref) for f in filenames]
+    n = len(filenames)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(plot_result, filenames, [out_dir] * n, [None] * n, [ref] * n))
+
+
+def main(argv=None):
+    """
+    python plotting.py [result file or glob ...] [-o figure dir] [-j N]
+    [--ref LAT LON]; the default is every result/*/*.txt
+    """
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="lat/lon, NEU and velocity figures of result files")
+    parser.add_argument('results', nargs='*', help="result files (.txt or .npy) or glob patterns")
+    parser.add_argument('-o', '--out', default=os.path.join(base_dir, 'result', 'figure'))
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--ref', type=float, nargs=2, metavar=('LAT', 'LON'),
+                        help="reference position in degree for all files, default the %s "
+                             "next to each result, else the session mean" % REF_FILE)
+    args = parser.parse_args(argv)
+    patterns = args.results or [os.path.join(base_dir, 'result', '*', '*.txt')]
+    filenames = sorted(set(f for p in patterns for f in glob.glob(p)))
+    if not filenames:
+        parser.error("no result file found")
+    for filename, files in zip(filenames, plot_results(filenames, args.out, args.jobs, args.ref)):
+        if files:
+            print("\n".join(files))
+        else:
+            print("skip %s: empty result" % filename, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -62,6 +62,115 @@ def radian2degree(rad):
     return rad * 180. / GEO_PI
 
 
+def _ellipsoid(ell):
+    """ semi-major axis, flattening and first eccentricity squared of ell """
+    a_ell = ELLIPSOIDS[ell]['a']
+    f_ell = ELLIPSOIDS[ell]['f']
+    return a_ell, f_ell, f_ell * (2 - f_ell)
+
+
+def xyz2blh_batch(xyz, ell='wgs84'):
+    """
+    Convert Cartesian coordinates of many points to geographical coordinates.
+
+    :param xyz: x, y, z coordinates, shape (..., 3), e.g. a whole trajectory (N, 3)
+    :type xyz: numpy.ndarray
+    :param ell: ellipsoid name, any key of `ELLIPSOIDS`.
+    :return: latitude and longitude in decimal degree and height, shape (..., 3)
+    :rtype: numpy.ndarray
+
+    Example usage::
+
+    >> xyz2blh_batch(np.array([[6378137., 0, 0]]), 'wgs84')
+    >> array([[0., 0., 0.]])
+    """
+    a_ell, f_ell, e2_ell = _ellipsoid(ell)
+    xyz = np.asarray(xyz, dtype=float)
+    xcoordinate, ycoordinate, zcoordinate = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    lon_ell = np.arctan2(ycoordinate, xcoordinate)
+    p_ell = np.sqrt(xcoordinate**2 + ycoordinate**2)
+    r_ell = np.sqrt(p_ell**2 + zcoordinate**2)
+    u_ell = np.arctan2(zcoordinate * ((1 - f_ell) +
+                                      e2_ell * a_ell / r_ell), p_ell)
+    lat_ell = np.arctan2(zcoordinate * (1 - f_ell) + e2_ell * a_ell * np.sin(u_ell)
+                         ** 3, (1 - f_ell) * (p_ell - e2_ell * a_ell * np.cos(u_ell)**3))
+    height = p_ell * np.cos(lat_ell) + zcoordinate * np.sin(lat_ell) - \
+        a_ell * np.sqrt(1 - e2_ell * np.sin(lat_ell)**2)
+    return np.stack([radian2degree(lat_ell), radian2degree(lon_ell), height], axis=-1)
+
+
+def blh2xyz_batch(blh, ell='wgs84'):
+    """
+    Convert geographical coordinates of many points to Cartesian coordinates.
+
+    :param blh: latitude and longitude in decimal degree and height, shape (..., 3)
+    :type blh: numpy.ndarray
+    :param ell: ellipsoid name, any key of `ELLIPSOIDS`.
+    :return: x, y, z coordinates, shape (..., 3)
+    :rtype: numpy.ndarray
+    """
+    a_ell, f_ell, e2_ell = _ellipsoid(ell)
+    blh = np.asarray(blh, dtype=float)
+    lat_radian = degree2radian(blh[..., 0])
+    lon_radian = degree2radian(blh[..., 1])
+    height = blh[..., 2]
+    sin_lat = np.sin(lat_radian)
+    n_ell = a_ell / np.sqrt(1 - e2_ell * sin_lat * sin_lat)
+    return np.stack([(n_ell + height) * np.cos(lat_radian) * np.cos(lon_radian),
+                     (n_ell + height) * np.cos(lat_radian) * np.sin(lon_radian),
+                     ((1 - e2_ell) * n_ell + height) * sin_lat], axis=-1)
+
+
+def neu_matrix(base_xyz, ell='wgs84'):
+    """
+    Rotation from Cartesian coordinate differences to NEU at a base station.
+
+    :param base_xyz: x, y, z coordinates of the base station
+    :param ell: ellipsoid name, any key of `ELLIPSOIDS`.
+    :return: 3x3 matrix whose rows are the N, E and U axes
+    :rtype: numpy.ndarray
+    """
+    lat_deg, lon_deg, _ = xyz2blh_batch(base_xyz, ell)
+    lat_radian = degree2radian(lat_deg)
+    lon_radian = degree2radian(lon_deg)
+    sin_lat, cos_lat = np.sin(lat_radian), np.cos(lat_radian)
+    sin_lon, cos_lon = np.sin(lon_radian), np.cos(lon_radian)
+    return np.array([[-sin_lat * cos_lon, -sin_lat * sin_lon, cos_lat],
+                     [-sin_lon, cos_lon, 0],
+                     [cos_lat * cos_lon, cos_lat * sin_lon, sin_lat]])
+
+
+def xyz2neu_batch(base_xyz, rover_xyz, ell='wgs84'):
+    """
+    Convert Cartesian coordinates of many rover points to NEU of one base station.
+
+    :param base_xyz: x, y, z coordinates of base station, shape (3,)
+    :param rover_xyz: x, y, z coordinates of rover points, shape (..., 3)
+    :param ell: ellipsoid name, any key of `ELLIPSOIDS`.
+    :return: N, E, U coordinates, shape (..., 3)
+    :rtype: numpy.ndarray
+
+    The base rotation is computed once for all rover points.
+    """
+    base_xyz = np.asarray(base_xyz, dtype=float)
+    return (np.asarray(rover_xyz, dtype=float) - base_xyz) @ neu_matrix(base_xyz, ell).T
+
+
+def neu2xyz_batch(base_xyz, neu, ell='wgs84'):
+    """
+    Convert NEU coordinates of many points relative to one base station to
+    Cartesian coordinates.
+
+    :param base_xyz: x, y, z coordinates of base station, shape (3,)
+    :param neu: N, E, U coordinates, shape (..., 3)
+    :param ell: ellipsoid name, any key of `ELLIPSOIDS`.
+    :return: x, y, z coordinates of rover points, shape (..., 3)
+    :rtype: numpy.ndarray
+    """
+    base_xyz = np.asarray(base_xyz, dtype=float)
+    return np.asarray(neu, dtype=float) @ neu_matrix(base_xyz, ell) + base_xyz
+
+
 def xyz2blh(xcoordinate, ycoordinate, zcoordinate, ell='wgs84'):
     """
     Convert Cartesian Coordinate system to geographical coordinate system.
@@ -81,24 +190,8 @@ def xyz2blh(xcoordinate, ycoordinate, zcoordinate, ell='wgs84'):
     >> xyz2blh(6378137., 0, 0, 'wgs84')
     >> (0.0, 0.0, 0.0)
     """
-
-    a_ell = ELLIPSOIDS[ell]['a']
-    f_ell = ELLIPSOIDS[ell]['f']
-    e2_ell = f_ell * (2 - f_ell)
-    # l = np.atan2(y,x)
-    lon_ell = np.arctan2(ycoordinate, xcoordinate)
-    p_ell = np.sqrt(xcoordinate**2 + ycoordinate**2)
-    r_ell = np.sqrt(p_ell**2 + zcoordinate**2)
-    u_ell = np.arctan2(zcoordinate * ((1 - f_ell) +
-                                      e2_ell * a_ell / r_ell), p_ell)
-    lat_ell = np.arctan2(zcoordinate * (1 - f_ell) + e2_ell * a_ell * np.sin(u_ell)
-                         ** 3, (1 - f_ell) * (p_ell - e2_ell * a_ell * np.cos(u_ell)**3))
-
-    height = p_ell * np.cos(lat_ell) + zcoordinate * np.sin(lat_ell) - \
-        a_ell * np.sqrt(1 - e2_ell * np.sin(lat_ell)**2)
-    lat_deg = radian2degree(lat_ell)  # / Deg2Rad
-    lon_deg = radian2degree(lon_ell)  # / Deg2Rad
-    return lat_deg, lon_deg, height
+    blh = xyz2blh_batch(np.stack(np.broadcast_arrays(xcoordinate, ycoordinate, zcoordinate), axis=-1), ell)
+    return blh[..., 0][()], blh[..., 1][()], blh[..., 2][()]
 
 
 def blh2xyz(lat_deg, lon_deg, height, ell='wgs84'):
@@ -120,16 +213,8 @@ def blh2xyz(lat_deg, lon_deg, height, ell='wgs84'):
     >> xyz2blh(6378137., 0, 0, 'wgs84')
     >> (0.0, 0.0, 0.0)
     """
-    a_ell = ELLIPSOIDS[ell]['a']
-    f_ell = ELLIPSOIDS[ell]['f']
-    e2_ell = f_ell * (2 - f_ell)
-    lat_radian = degree2radian(lat_deg)
-    lon_radian = degree2radian(lon_deg)
-    n_ell = a_ell / math.sqrt(1 - e2_ell * math.sin(lat_radian) * math.sin(lat_radian))
-    xcoordinate = (n_ell + height) * math.cos(lat_radian) * math.cos(lon_radian)
-    ycoordinate = (n_ell + height) * math.cos(lat_radian) * math.sin(lon_radian)
-    zcoordinate = ((1 - e2_ell) * n_ell + height) * math.sin(lat_radian)
-    return xcoordinate, ycoordinate, zcoordinate
+    xyz = blh2xyz_batch(np.stack(np.broadcast_arrays(lat_deg, lon_deg, height), axis=-1), ell)
+    return xyz[..., 0][()], xyz[..., 1][()], xyz[..., 2][()]
 
 
 def neu2xyz(ncoordinate, ecoordinate, ucoordinate, base_xcoordinate, base_ycoordinate, base_zcoordinate, ell='wgs84'):
@@ -157,19 +242,9 @@ def neu2xyz(ncoordinate, ecoordinate, ucoordinate, base_xcoordinate, base_ycoord
     >> neu2xyz(-1.3073, 0.4840, -2.2613, -2267823.811, 5009335.937, 3220977.864, 'wgs84')
     >> (0.0, 0.0, 0.0)
     """
-    lat_deg, lon_deg, height = xyz2blh(base_xcoordinate, base_ycoordinate, base_zcoordinate, ell)
-    lat_radian = degree2radian(lat_deg)
-    lon_radian = degree2radian(lon_deg)
-    neu_matrix = np.array([[ncoordinate], [ecoordinate], [ucoordinate]])
-    base_coordinate = np.array([[base_xcoordinate], [base_ycoordinate], [base_zcoordinate]])
-    transfer_matrix = np.array([[-math.sin(lat_radian) * math.cos(lon_radian), -math.sin(lon_radian),
-                                 math.cos(lat_radian) * math.cos(lon_radian)],
-                                [-math.sin(lat_radian) * math.sin(lon_radian), math.cos(lon_radian),
-                                 math.cos(lat_radian) * math.sin(lon_radian)],
-                                [math.cos(lat_radian), 0, math.sin(lat_radian)]])
-    differcence_coordinate = np.dot(transfer_matrix, neu_matrix)
-    rover_coordinate = differcence_coordinate + base_coordinate
-    return rover_coordinate[0][0], rover_coordinate[1][0], rover_coordinate[2][0]
+    xyz = neu2xyz_batch([base_xcoordinate, base_ycoordinate, base_zcoordinate],
+                        np.stack(np.broadcast_arrays(ncoordinate, ecoordinate, ucoordinate), axis=-1), ell)
+    return xyz[..., 0][()], xyz[..., 1][()], xyz[..., 2][()]
 
 
 def xyz2neu(base_xcoordinate, base_ycoordinate, base_zcoordinate, rover_xcoordinate, rover_ycoordinate, rover_zcoordinate, ell='wgs84'):
@@ -197,16 +272,6 @@ def xyz2neu(base_xcoordinate, base_ycoordinate, base_zcoordinate, rover_xcoordin
     >> xyz2neu(-2267823.811, 5009335.937, 3220977.864, -2267823.7225, 5009334.5679, 3220975.5893, 'wgs84')
     >> (-1.3073 0.4840 -2.2613)
     """
-    lat_deg, lon_deg, height = xyz2blh(base_xcoordinate, base_ycoordinate, base_zcoordinate, ell)
-    lat_radian = degree2radian(lat_deg)
-    lon_radian = degree2radian(lon_deg)
-    base_coordinate = np.array([[base_xcoordinate], [base_ycoordinate], [base_zcoordinate]])
-    rover_coordinate = np.array([[rover_xcoordinate], [rover_ycoordinate], [rover_zcoordinate]])
-    difference_coordinate = rover_coordinate - base_coordinate
-    transfer_matrix = np.array(
-        [[-math.sin(lat_radian) * math.cos(lon_radian), -math.sin(lat_radian) * math.sin(lon_radian),
-          math.cos(lat_radian)], [-math.sin(lon_radian), math.cos(lon_radian), 0],
-         [math.cos(lat_radian) * math.cos(lon_radian), math.cos(lat_radian) * math.sin(lon_radian),
-          math.sin(lat_radian)]])
-    neu_coordinate = np.dot(transfer_matrix, difference_coordinate)
-    return neu_coordinate[0][0], neu_coordinate[1][0], neu_coordinate[2][0]
+    neu = xyz2neu_batch([base_xcoordinate, base_ycoordinate, base_zcoordinate],
+                        np.stack(np.broadcast_arrays(rover_xcoordinate, rover_ycoordinate, rover_zcoordinate), axis=-1), ell)
+    return neu[..., 0][()], neu[..., 1][()], neu[..., 2][()]
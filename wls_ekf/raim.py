@@ -0,0 +1,154 @@
+## RAIM fault detection and exclusion with leave-one-out downdates
+
+from functools import lru_cache
+import numpy as np
+from gnsscommon import *
+
+RAIM_SIGMA0 = 3.0       # pseudorange std at zenith (m) of the test model
+RAIM_PFA = 1e-3         # false alarm probability of the chi-square test
+RAIM_MAX_EXCLUDE = 3    # max satellites excluded per epoch
+# weight of a zenith pseudorange row (get_weight_based_elevation), the
+# weights of the estimators are relative to it
+RAIM_W_ZENITH = get_weight_based_elevation(np.pi / 2)
+
+
+@lru_cache(maxsize=None)
+def chi2_threshold(dof, pfa=RAIM_PFA):
+    """ chi-square quantile 1-pfa with dof degrees of freedom (exact, kept
+    per dof since the tests of a session only see a few) """
+    from scipy.stats import chi2  # slow import, only paid when fde is on
+    return float(chi2.ppf(1.0 - pfa, int(dof)))
+
+
+def test_variance(w, sigma0=RAIM_SIGMA0):
+    """ variances of the test model for rows of weights w: a zenith
+    pseudorange row has sigma0**2, the others scale as 1/w """
+    return sigma0 ** 2 * RAIM_W_ZENITH / w
+
+
+def _blocks(sat):
+    """ satellites u of the rows and (block, slot) of every row in a
+    (len(u), 2) layout; a satellite owns its pseudorange row and, if
+    present, its doppler row """
+    u, first, inv = np.unique(sat, return_index=True, return_inverse=True)
+    return u, inv, np.arange(len(sat)) - first[inv]
+
+
+def loo_wls(A, r, Q, sat):
+    """ leave-one-satellite-out of a weighted least squares solution ---------
+    * args   : ndarray A        I   whitened design matrix (n, 8)
+    *          ndarray r        I   whitened residuals at the solution (n,)
+    *          ndarray Q        I   (A'A)^-1 (8, 8)
+    *          ndarray sat      I   satellite of every row (n,)
+    * return : u (m,) satellites, dsse (m,) decrease of the residual sum of
+    *          squares without u[k], dx (m, 8) change of the solution,
+    *          dQ (m, 8, 8) change of Q; dsse is nan where leaving u[k]
+    *          out makes the problem singular
+    * notes  : removing the rows S of a satellite is a rank-1/2 downdate,
+    *          with M = A_S Q A_S' and c = (I - M)^-1 r_S:
+    *          dsse = r_S' c, dx = -Q A_S' c, dQ = Q A_S' (I - M)^-1 A_S Q.
+    *          all satellites cost O(n 8^2), about one normal matrix """
+    u, blk, slot = _blocks(sat)
+    As = np.zeros((len(u), 2, A.shape[1]))
+    rs = np.zeros((len(u), 2))
+    As[blk, slot] = A
+    rs[blk, slot] = r
+    G = As @ Q
+    IM = np.eye(2) - G @ np.swapaxes(As, 1, 2)
+    ok = np.abs(np.linalg.det(IM)) > 1e-9
+    IMinv = np.zeros_like(IM)
+    IMinv[ok] = np.linalg.inv(IM[ok])
+    c = (IMinv @ rs[..., None])[..., 0]
+    dsse = np.where(ok, np.sum(rs * c, axis=1), np.nan)
+    dx = -(np.swapaxes(G, 1, 2) @ c[..., None])[..., 0]
+    dQ = np.swapaxes(G, 1, 2) @ IMinv @ G
+    return u, dsse, dx, dQ
+
+
+def fde_wls(H, w, r, Q, sat, sigma0=RAIM_SIGMA0, pfa=RAIM_PFA, maxexclude=RAIM_MAX_EXCLUDE):
+    """ chi-square test and exclusion of a converged WLS epoch --------------
+    * args   : ndarray H, w     I   design matrix (n, 8) and weights (n,)
+    *          ndarray r        I   residuals v - H dx at the solution (n,)
+    *          ndarray Q        I   covariance (H'WH)^-1 of the solution
+    *          ndarray sat      I   satellite of every row (n,)
+    * return : dx (8,) correction of the solution, Q after exclusion, list
+    *          of excluded satellites, test statistic and whether it passes
+    * notes  : while the weighted residual sum of squares (in units of
+    *          the test variances) exceeds the chi-square threshold, the
+    *          satellite whose removal decreases it most is excluded by a
+    *          downdate (see loo_wls), no new factorization is made """
+    # whitened by the test variances, Q in the same units
+    sw = 1.0 / np.sqrt(test_variance(w, sigma0))
+    A = H * sw[:, None]
+    r = r * sw
+    scale = sigma0 ** 2 * RAIM_W_ZENITH
+    Q = Q * scale
+    used = np.ones(len(r), dtype=bool)
+    dx = np.zeros(H.shape[1])
+    excluded = []
+    while True:
+        dof = used.sum() - H.shape[1]
+        T = r[used] @ r[used]
+        if dof <= 0 or T <= chi2_threshold(dof, pfa):
+            return dx, Q / scale, excluded, T, dof > 0
+        if len(excluded) >= maxexclude:
+            return dx, Q / scale, excluded, T, False
+        u, dsse, dxk, dQ = loo_wls(A[used], r[used], Q, sat[used])
+        # keep enough rows for a test after the exclusion
+        nrow = np.bincount(np.searchsorted(u, sat[used]), minlength=len(u))
+        dsse[used.sum() - nrow - H.shape[1] <= 0] = np.nan
+        if np.all(np.isnan(dsse)):
+            return dx, Q / scale, excluded, T, False
+        k = np.nanargmax(dsse)
+        dx += dxk[k]
+        Q = Q + dQ[k]
+        used &= sat != u[k]
+        r = np.where(used, r - A @ dxk[k], 0.0)
+        excluded.append(u[k])
+
+
+def fde_innovation(y, S, sat, maxexclude=RAIM_MAX_EXCLUDE, pfa=RAIM_PFA):
+    """ chi-square test and exclusion of an innovation ------------------------
+    * args   : ndarray y        I   innovations (n,)
+    *          ndarray S        I   their covariance (n, n)
+    *          ndarray sat      I   satellite of every row (n,)
+    * return : list of excluded satellites, final statistic y'S^-1 y and
+    *          whether it passes the test
+    * notes  : with z = S^-1 y, leaving the rows R of a satellite out
+    *          lowers the statistic by z_R' ((S^-1)_RR)^-1 z_R; S^-1 is
+    *          downdated after an exclusion (Schur complement, O(n^2)),
+    *          so only one inverse is computed per epoch """
+    Sinv = np.linalg.inv(S)
+    used = np.ones(len(y), dtype=bool)
+    excluded = []
+    while True:
+        z = Sinv @ np.where(used, y, 0.0)
+        T = y[used] @ z[used]
+        dof = used.sum()
+        passed = dof > 0 and T <= chi2_threshold(dof, pfa)
+        if passed or dof <= 0 or len(excluded) >= maxexclude:
+            return excluded, T, passed
+        u, blk, slot = _blocks(sat[used])
+        idx = np.full((len(u), 2), -1)
+        idx[blk, slot] = np.flatnonzero(used)
+        D = np.tile(np.eye(2), (len(u), 1, 1))
+        zs = np.zeros((len(u), 2))
+        two = idx[:, 1] >= 0
+        i0, i1 = idx[:, 0], np.where(two, idx[:, 1], idx[:, 0])
+        D[:, 0, 0] = Sinv[i0, i0]
+        D[two, 0, 1] = Sinv[i0, i1][two]
+        D[two, 1, 0] = Sinv[i1, i0][two]
+        D[two, 1, 1] = Sinv[i1, i1][two]
+        zs[:, 0] = z[i0]
+        zs[two, 1] = z[i1][two]
+        dT = np.sum(zs * np.linalg.solve(D, zs[..., None])[..., 0], axis=1)
+        # keep at least one row besides the excluded satellite
+        dT[used.sum() - 1 - two <= 0] = -np.inf
+        k = int(np.argmax(dT))
+        if not np.isfinite(dT[k]):
+            return excluded, T, False
+        R = idx[k][idx[k] >= 0]
+        # downdate of the inverse: drop rows/cols R of S
+        Sinv = Sinv - Sinv[:, R] @ np.linalg.solve(Sinv[np.ix_(R, R)], Sinv[R, :])
+        used[R] = False
+        excluded.append(u[k])
@@ -1,10 +1,118 @@
 # read obs and eph file of .mat format from matlab
-import scipy.io
+import os
+import json
+import shutil
+import itertools
 import numpy as np
 from gnsscommon import *
 from ephemeris import *
 
-def read_eph_mat(mat_filename):
+CACHE_SUFFIX = '.npycache'  # binary cache directory next to the .mat file
+CACHE_VERSION = 1
+CACHE_BLOCK = 1000  # epochs packed at a time when a cache is built
+
+
+def cache_dir(mat_filename):
+    return mat_filename + CACHE_SUFFIX
+
+
+def _source_stamp(mat_filename):
+    st = os.stat(mat_filename)
+    return {'version': CACHE_VERSION, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def load_cache(mat_filename):
+    """ memory-mapped columns of the binary cache of mat_filename ---------
+    * return : dict of name -> read-only np.memmap, or None if there is no
+    *          cache or the .mat file changed (size or mtime) since it was
+    *          written. a cache without source (generated data, see
+    *          synthetic.py) is used as it is """
+    path = cache_dir(mat_filename)
+    try:
+        with open(os.path.join(path, 'source.json')) as f:
+            stamp = json.load(f)
+        if stamp['source'] is not None and stamp['source'] != _source_stamp(mat_filename):
+            return None
+        return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                for name in stamp['columns']}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_cache(mat_filename, columns, source=True):
+    """ write columns (dict of name -> array) as .npy files next to the
+    .mat file, see save_cache_blocks """
+    return save_cache_blocks(mat_filename, [columns], source)
+
+
+def save_cache_blocks(mat_filename, blocks, source=True):
+    """ write the cache of mat_filename from blocks (iterable of dicts of
+    name -> 1-d array, the columns of consecutive rows). each block is
+    appended to the column files as it comes, so only one block is held in
+    memory. the directory is swapped in whole so readers never see a
+    partial cache. with source=False the cache is not tied to a .mat file,
+    which does not need to exist (generated data)
+    * return : False if the cache could not be written (e.g. read-only data
+    *          directory) """
+    path = cache_dir(mat_filename)
+    tmp = path + '.tmp%d' % os.getpid()
+    files, dtypes, sizes = {}, {}, {}
+    try:
+        os.makedirs(tmp)
+        for block in blocks:
+            for name, a in block.items():
+                if name not in files:
+                    files[name] = open(os.path.join(tmp, name + '.raw'), 'wb')
+                    dtypes[name], sizes[name] = np.asarray(a).dtype, 0
+                np.ascontiguousarray(a, dtype=dtypes[name]).tofile(files[name])
+                sizes[name] += len(a)
+        for name, f in files.items():
+            f.close()
+            # .npy header for the final length, then the raw column
+            raw = os.path.join(tmp, name + '.raw')
+            with open(raw, 'rb') as fr, open(os.path.join(tmp, name + '.npy'), 'wb') as fw:
+                np.lib.format.write_array_header_1_0(fw, {
+                    'descr': np.lib.format.dtype_to_descr(dtypes[name]),
+                    'fortran_order': False, 'shape': (sizes[name],)})
+                shutil.copyfileobj(fr, fw)
+            os.remove(raw)
+        with open(os.path.join(tmp, 'source.json'), 'w') as f:
+            json.dump({'source': _source_stamp(mat_filename) if source else None,
+                       'columns': list(files)}, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+        return True
+    except OSError:
+        for f in files.values():
+            f.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+        return False
+
+
+def dataset_file_exists(mat_filename):
+    """ True if the .mat file or a binary cache of it exists """
+    return os.path.isfile(mat_filename) or os.path.isfile(
+        os.path.join(cache_dir(mat_filename), 'source.json'))
+
+
+def read_eph_mat(mat_filename, use_cache=True):
+    """ ephemerides of an ephData.mat export as an EphStore, read from the
+    binary cache when it is up to date """
+    columns = load_cache(mat_filename) if use_cache else None
+    if columns is not None:
+        table = Eph()
+        for name in EPH_FIELDS:
+            setattr(table, name, np.array(columns[name]))
+        return EphStore(unstack_eph(table))
+    all_eph = parse_eph_mat(mat_filename)
+    if use_cache:
+        table = stack_eph(all_eph.ephs)
+        save_cache(mat_filename, {name: getattr(table, name) for name in EPH_FIELDS})
+    return all_eph
+
+
+def parse_eph_mat(mat_filename):
+    import scipy.io  # only needed when there is no binary cache
     mat_data = scipy.io.loadmat(mat_filename, squeeze_me=True, struct_as_record=False)
     ephData = mat_data['ephData']
     all_eph = []
@@ -43,12 +151,31 @@ def read_eph_mat(mat_filename):
             all_eph.append(eph)
     except (IndexError, AttributeError):
         pass
-    return all_eph
+    return EphStore(all_eph)
+
+def iter_obs_mat(mat_filename, use_cache=True):
+    """ yield the epochs of an obsData.mat export one Obs at a time as views
+    into the memory map of the binary cache, which is built first if it is
+    missing (see build_obs_cache). only the cache bounds the memory: without
+    it (use_cache=False, or a data directory that cannot be written) the
+    epochs come from parse_obs_mat, which holds the whole .mat file """
+    columns = load_cache(mat_filename) if use_cache else None
+    if columns is None and use_cache and build_obs_cache(mat_filename):
+        columns = load_cache(mat_filename)
+    if columns is not None:
+        yield from ObsStore(**columns)
+        return
+    yield from parse_obs_mat(mat_filename)
 
-def read_obs_mat(mat_filename):
-    mat_data = scipy.io.loadmat(mat_filename, squeeze_me=True,struct_as_record=False)
-    obs_data = mat_data['obsData']
-    all_obs = []
+
+def parse_obs_mat(mat_filename):
+    """ walk the MATLAB structs of an obsData.mat export, one Obs per epoch.
+    the export is a single compressed MATLAB 5 variable, which scipy.io
+    reads whole: the structs of all epochs stay in memory until the last
+    epoch has been yielded """
+    import scipy.io  # only needed when there is no binary cache
+    obs_data = scipy.io.loadmat(mat_filename, squeeze_me=True,
+                                struct_as_record=False)['obsData']
     for i in range(len(obs_data)):
         try:
             tmp_obs = Obs()
@@ -63,8 +190,42 @@ def read_obs_mat(mat_filename):
                 tmp_obs.corP.append(channel.corrP)
                 tmp_obs.D.append(channel.doppler)
                 tmp_obs.SNR.append(channel.SNR)
-            all_obs.append(tmp_obs)
         except (IndexError, AttributeError):
-            pass
-    return all_obs
+            continue
+        yield tmp_obs
+
+
+def obs_blocks(epochs, size=CACHE_BLOCK):
+    """ cache columns (ObsStore.FIELDS and offsets) of the epochs, packed
+    size epochs at a time; offsets continue across the blocks """
+    yield dict({name: np.zeros(0, dtype) for name, dtype in ObsStore.FIELDS.items()},
+               offsets=np.zeros(1, dtype=np.int64))
+    base = 0
+    epochs = iter(epochs)
+    while True:
+        block = ObsStore.from_epochs(itertools.islice(epochs, size))
+        if len(block) == 0:
+            return
+        columns = {name: getattr(block, name) for name in ObsStore.FIELDS}
+        yield dict(columns, offsets=block.offsets[1:] + base)
+        base += block.offsets[-1]
+
+
+def build_obs_cache(mat_filename):
+    """ write the binary cache of an obsData.mat export block by block,
+    without collecting the epochs of the session first. the peak memory is
+    that of parse_obs_mat (the loaded .mat file) plus one block
+    * return : False if the cache could not be written """
+    return save_cache_blocks(mat_filename, obs_blocks(parse_obs_mat(mat_filename)))
+
 
+def read_obs_mat(mat_filename, use_cache=True):
+    """ observations of an obsData.mat export as an ObsStore whose columns
+    are memory-mapped from the binary cache, which is built on first read
+    (see build_obs_cache) """
+    columns = load_cache(mat_filename) if use_cache else None
+    if columns is None and use_cache and build_obs_cache(mat_filename):
+        columns = load_cache(mat_filename)
+    if columns is not None:
+        return ObsStore(**columns)
+    return ObsStore.from_epochs(parse_obs_mat(mat_filename))
@@ -0,0 +1,276 @@
+## asyncio streaming EKF service with a per-epoch deadline, and a replay
+## tool feeding an obsData.mat export at its real rate
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+from ekf import *
+from resultio import *
+
+RT_DEADLINE = 0.1       # time from arrival to fix of an epoch (s)
+RT_MIN_ITER = 1         # iterations kept however late an epoch is
+RT_MARGIN = 0.8         # share of the remaining budget spent iterating
+RT_COST_GAIN = 0.2      # gain of the running per-iteration cost estimate
+RT_HOST = '127.0.0.1'
+RT_PORT = 5005
+
+
+def obs_to_record(obs):
+    """ one epoch as a JSON line (fields of ObsStore.FIELDS) """
+    return json.dumps({name: np.asarray(getattr(obs, name)).tolist()
+                       for name in ObsStore.FIELDS}) + '\n'
+
+
+def record_to_obs(line):
+    """ Obs of a JSON line written by obs_to_record """
+    rec = json.loads(line)
+    obs = Obs()
+    for name, dtype in ObsStore.FIELDS.items():
+        setattr(obs, name, np.asarray(rec.get(name, []), dtype=dtype))
+    return obs
+
+
+class RealtimeEkf():
+    """ EKF of a live epoch stream with a latency budget
+
+    every epoch has deadline seconds from its arrival to its fix. the
+    iterations of the EKF update are capped to what the remaining budget
+    affords at the running cost per iteration (at least RT_MIN_ITER), and
+    an epoch that is already past its deadline while newer ones are
+    waiting is skipped, the filter prediction bridges the gap. the latency
+    and status (ok, degraded: fewer iterations than MAXITR allowed,
+    skipped, nofix: fewer than 4 satellites) of every epoch are kept for
+    the summary.
+    """
+
+    def __init__(self, all_eph, mode=EKF_JOSEPH, deadline=RT_DEADLINE, fde=False, orbit=None):
+        self.ekf = EkfFilter(all_eph, mode, orbit, fde)
+        self.deadline = deadline
+        self.iter_cost = None
+        self.latency = []
+        self.status = {'ok': 0, 'degraded': 0, 'skipped': 0, 'nofix': 0}
+        self.missed = 0
+
+    def max_iterations(self, arrival):
+        """ iterations affordable for an epoch that arrived at arrival """
+        if self.iter_cost is None:
+            return MAXITR
+        budget = self.deadline - (time.perf_counter() - arrival)
+        n = int(budget * RT_MARGIN / self.iter_cost)
+        return min(max(n, RT_MIN_ITER), MAXITR)
+
+    def process(self, obs, arrival):
+        """ filter one epoch, return its output record """
+        if len(obs.sat) < 4:
+            return self._done({'tow': float(obs.t[0]) if len(obs.t) else None}, 'nofix', arrival)
+        maxiter = self.max_iterations(arrival)
+        counts = []
+        t0 = time.perf_counter()
+        row = self.ekf.update(obs, counts=counts, maxiter=maxiter)
+        cost = (time.perf_counter() - t0) / max(counts[-1], 1)
+        self.iter_cost = cost if self.iter_cost is None else \
+            self.iter_cost + RT_COST_GAIN * (cost - self.iter_cost)
+        rec = dict(zip(RESULT_COLUMNS, map(float, row)))
+        rec['iter'] = counts[-1]
+        return self._done(rec, 'ok' if maxiter == MAXITR else 'degraded', arrival)
+
+    def skip(self, obs, arrival):
+        return self._done({'tow': float(obs.t[0]) if len(obs.t) else None}, 'skipped', arrival)
+
+    def _done(self, rec, status, arrival):
+        latency = time.perf_counter() - arrival
+        self.status[status] += 1
+        if status != 'skipped':
+            self.latency.append(latency)
+            self.missed += latency > self.deadline
+        rec['status'] = status
+        rec['latency'] = latency
+        return rec
+
+    def summary(self):
+        lat = np.array(self.latency) * 1e3
+        s = ' '.join('%s:%d' % kv for kv in self.status.items())
+        if len(lat):
+            s += "  latency ms p50 %.1f p95 %.1f max %.1f  deadline %.0f ms missed %d" % (
+                np.percentile(lat, 50), np.percentile(lat, 95), lat.max(),
+                self.deadline * 1e3, self.missed)
+        return s
+
+
+async def serve_stream(reader, write, rt, writer=None):
+    """ filter the epochs read from reader (JSON lines, see obs_to_record)
+    with the RealtimeEkf rt and pass each output record to write (a
+    function of one JSON line); rows with a fix also go to the
+    ResultWriter writer. the reader is drained while an epoch is filtered
+    (in a worker thread) so arrival times stay exact and late epochs can
+    be skipped """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    async def ingest():
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            if line.strip():
+                queue.put_nowait((time.perf_counter(), line))
+        queue.put_nowait(None)
+
+    task = asyncio.ensure_future(ingest())
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            arrival, line = item
+            obs = record_to_obs(line)
+            late = time.perf_counter() - arrival > rt.deadline
+            if late and not queue.empty():
+                rec = rt.skip(obs, arrival)
+            else:
+                rec = await loop.run_in_executor(None, rt.process, obs, arrival)
+            if writer is not None and 'x' in rec:
+                writer.write([rec[name] for name in RESULT_COLUMNS])
+            await write(json.dumps(rec) + '\n')
+    finally:
+        task.cancel()
+
+
+async def serve(eph_filename, listen=None, mode=EKF_JOSEPH, deadline=RT_DEADLINE, out=None,
+                fde=False, orbit_cache_dir=None):
+    """ run the service on a TCP address (host, port), one filter per
+    connection, or on stdin/stdout when listen is None. with
+    orbit_cache_dir the orbits are interpolated from the fits kept there
+    (see OrbitCache), built once for all connections """
+    all_eph = read_eph_mat(eph_filename)
+    orbit = OrbitCache(all_eph, cache_dir=orbit_cache_dir) if orbit_cache_dir else None
+
+    async def run(reader, write):
+        rt = RealtimeEkf(all_eph, mode, deadline, fde, orbit)
+        writer = ResultWriter(out) if out else None
+        try:
+            await serve_stream(reader, write, rt, writer)
+        finally:
+            if writer is not None:
+                writer.close()
+            print(rt.summary(), file=sys.stderr)
+
+    if listen is None:
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+        async def write(line):
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        await run(reader, write)
+        return
+
+    async def client(reader, stream_writer):
+        async def write(line):
+            stream_writer.write(line.encode())
+            await stream_writer.drain()
+        try:
+            await run(reader, write)
+        except ConnectionError:
+            pass
+        finally:
+            stream_writer.close()
+
+    server = await asyncio.start_server(client, *listen)
+    print("listening on %s:%d" % listen, file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+
+async def replay(obs_filename, connect=None, speed=1.0):
+    """ send the epochs of obs_filename at the rate of their time tags
+    (speed times faster) to a service at connect (host, port), printing
+    its output, or to stdout when connect is None """
+    all_obs = read_obs_mat(obs_filename)
+    if connect is None:
+        reader = None
+
+        async def send(line):
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    else:
+        reader, stream_writer = await asyncio.open_connection(*connect)
+
+        async def send(line):
+            stream_writer.write(line.encode())
+            await stream_writer.drain()
+
+    async def receive():
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            sys.stdout.write(line.decode())
+
+    task = asyncio.ensure_future(receive()) if reader is not None else None
+    t0 = time.perf_counter()
+    tow0 = None
+    for obs in all_obs:
+        if len(obs.t) == 0:
+            continue
+        tow0 = obs.t[0] if tow0 is None else tow0
+        delay = t0 + (obs.t[0] - tow0) / speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await send(obs_to_record(obs))
+    if reader is not None:
+        stream_writer.write_eof()
+        await task
+        stream_writer.close()
+
+
+def _address(s):
+    """ (host, port) of host:port, host or :port """
+    host, _, port = s.rpartition(':') if ':' in s else (s, ':', '')
+    return host or RT_HOST, int(port) if port else RT_PORT
+
+
+def main(argv=None):
+    """
+    python realtime.py serve ephData.mat [--listen host:port] [--deadline s]
+                             [--ekf-mode m] [-o result file] [--fde]
+                             [--orbit-cache dir]
+    python realtime.py replay obsData.mat [--connect host:port] [--speed x]
+    without --listen/--connect the service reads epochs from stdin and the
+    replay writes them to stdout, e.g.
+    python realtime.py replay data/Opensky/obsData.mat |
+        python realtime.py serve data/Opensky/ephData.mat
+    """
+    parser = argparse.ArgumentParser(description="streaming EKF service and replay tool")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('serve', help="filter epochs from a socket or stdin")
+    p.add_argument('eph', help="ephData.mat of the session")
+    p.add_argument('--listen', type=_address, help="TCP host:port (default stdin/stdout)")
+    p.add_argument('--deadline', type=float, default=RT_DEADLINE, help="latency budget (s)")
+    p.add_argument('--ekf-mode', default=EKF_JOSEPH,
+                   choices=[EKF_JOSEPH, EKF_SEQUENTIAL, EKF_SQRT, EKF_ITERATED])
+    p.add_argument('-o', '--out', help="also write the fixes to this result file")
+    p.add_argument('--fde', action='store_true', help="fault detection and exclusion")
+    p.add_argument('--orbit-cache', metavar='DIR', help="orbit fits kept in DIR")
+    p = sub.add_parser('replay', help="feed an obsData.mat at its real rate")
+    p.add_argument('obs', help="obsData.mat to replay")
+    p.add_argument('--connect', type=_address, help="TCP host:port (default stdout)")
+    p.add_argument('--speed', type=float, default=1.0, help="replay speed factor")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'serve':
+            asyncio.run(serve(args.eph, args.listen, args.ekf_mode, args.deadline, args.out,
+                              args.fde, args.orbit_cache))
+        else:
+            asyncio.run(replay(args.obs, args.connect, args.speed))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+## streaming writer and reader of the estimator results
+
+import os
+import struct
+import numpy as np
+
+RESULT_COLUMNS = ['tow', 'x', 'y', 'z', 'vx', 'vy', 'vz']
+RESULT_CHUNK = 1024     # rows buffered before a flush
+RESULT_FORMATS = ['txt', 'npy']
+NPY_HEADER_LEN = 128    # fixed .npy header size, rewritten in place on flush
+
+
+def result_format(filename):
+    """ output format from the file extension, text unless .npy """
+    return 'npy' if os.path.splitext(filename)[1].lower() == '.npy' else 'txt'
+
+
+def _npy_header(nrows, ncols):
+    """ .npy (version 1.0) header of a C-order float64 (nrows, ncols) array
+    padded to NPY_HEADER_LEN bytes, so it can be rewritten as rows are added """
+    header = "{'descr': '<f8', 'fortran_order': False, 'shape': (%d, %d), }" % (nrows, ncols)
+    header = header.ljust(NPY_HEADER_LEN - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class ResultWriter():
+    """ streaming result file, rows are pushed one at a time
+
+    rows are collected in a fixed size buffer and written every chunk rows,
+    so memory stays bounded whatever the session length. 'txt' writes the
+    usual text rows (tow, x, y, z, vx, vy, vz, %.3f), 'npy' appends float64
+    rows to a .npy file whose header is updated at every flush: the file is
+    a valid array of the rows written so far and can be memory-mapped by
+    read_result while the session is still running.
+    """
+
+    def __init__(self, filename, fmt=None, ncols=len(RESULT_COLUMNS), chunk=RESULT_CHUNK):
+        self.filename = filename
+        self.fmt = fmt or result_format(filename)
+        if self.fmt not in RESULT_FORMATS:
+            raise ValueError("unknown result format %s" % self.fmt)
+        self.ncols = ncols
+        self.buf = np.empty((chunk, ncols))
+        self.nbuf = 0
+        self.nrows = 0
+        self.f = open(filename, 'w' if self.fmt == 'txt' else 'wb')
+        if self.fmt == 'npy':
+            self.f.write(_npy_header(0, ncols))
+
+    def write(self, row):
+        self.buf[self.nbuf] = row
+        self.nbuf += 1
+        if self.nbuf == len(self.buf):
+            self.flush()
+
+    def write_rows(self, rows):
+        """ write all rows of an iterable (e.g. an estimator generator),
+        return the number of rows written """
+        n = 0
+        for row in rows:
+            self.write(row)
+            n += 1
+        return n
+
+    def flush(self):
+        rows = self.buf[:self.nbuf]
+        if self.fmt == 'txt':
+            np.savetxt(self.f, rows, fmt="%.3f  ", delimiter='')
+        else:
+            self.f.write(rows.astype('<f8').tobytes())
+            self.f.seek(0)
+            self.f.write(_npy_header(self.nrows + self.nbuf, self.ncols))
+            self.f.seek(0, os.SEEK_END)
+        self.f.flush()
+        self.nrows += self.nbuf
+        self.nbuf = 0
+
+    def close(self):
+        if not self.f.closed:
+            self.flush()
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_result(filename, mmap=True):
+    """ result rows (n, 7) of a text or .npy result file, a .npy file is
+    memory-mapped (read only) unless mmap is False """
+    if result_format(filename) == 'npy':
+        return np.load(filename, mmap_mode='r' if mmap else None)
+    return np.loadtxt(filename, ndmin=2)
@@ -0,0 +1,327 @@
+## synthetic GPS L1 observations from simulated broadcast orbits
+
+import os
+import argparse
+from copy import copy
+import numpy as np
+from numpy.linalg import norm
+from gnsscommon import *
+from ephemeris import *
+from design import *
+from read_mat import *
+
+SIM_WEEK = 2179                 # default session start, as the Opensky data
+SIM_TOW = 390108.0
+SIM_LLH = (22.328444770087565, 114.1713630049711, 10.0)  # deg, deg, m
+SIM_TOE = 396000.0              # reference toe of the generated constellation
+SIM_EPH_INTERVAL = 7200.0       # spacing of the generated ephemeris sets (s)
+SIM_NPLANE = 6                  # orbital planes of the generated constellation
+SIM_EL_MASK = np.deg2rad(5)     # satellites below are not tracked
+SIM_CHUNK = 2000                # epochs simulated per array pass
+SIM_SIGMA_P = 3.0               # pseudorange noise at zenith (m)
+SIM_SIGMA_D = 0.1               # doppler noise at zenith (m/s)
+SIM_CLK_BIAS = 1.0e4            # receiver clock bias at start (m)
+SIM_CLK_DRIFT = 1.0             # receiver clock drift (m/s)
+
+
+def synthetic_constellation(nsat, toe=SIM_TOE, week=SIM_WEEK, nplane=SIM_NPLANE, seed=0):
+    """ broadcast ephemerides of a walker-like constellation ----------------
+    * args   : int   nsat       I   number of satellites, numbered 1..nsat
+    *          float toe        I   time of ephemeris (gpst tow)
+    *          int   week       I   gps week
+    *          int   nplane     I   number of orbital planes
+    *          int   seed       I   seed of the random orbit/clock perturbations
+    * return : list of Eph, one per satellite
+    * notes  : GPS-like orbits (a=26560km, i=55deg) without harmonic
+    *          corrections, so they are exactly keplerian """
+    rng = np.random.default_rng(seed)
+    ephs = []
+    for k in range(nsat):
+        plane, slot = k % nplane, k // nplane
+        nslot = -(-nsat // nplane)
+        eph = Eph(k + 1)
+        eph.iode = eph.iodc = 0
+        eph.toe = eph.toc = eph.toes = toe
+        eph.week = week
+        eph.A = 26559.7e3 + rng.uniform(-30e3, 30e3)
+        eph.e = rng.uniform(0.001, 0.015)
+        eph.i0 = np.deg2rad(55.0) + rng.uniform(-0.02, 0.02)
+        eph.OMG0 = 2 * np.pi * plane / nplane + rng.uniform(-0.05, 0.05)
+        eph.OMGd = -8.0e-9
+        eph.omg = rng.uniform(-np.pi, np.pi)
+        # slots of neighbouring planes are phase shifted
+        eph.M0 = 2 * np.pi * (slot + plane / nplane) / nslot - eph.omg
+        eph.f0 = rng.uniform(-5e-4, 5e-4)
+        eph.f1 = rng.uniform(-1e-11, 1e-11)
+        eph.f2 = 0.0
+        eph.tgd = rng.uniform(-1e-8, 1e-8)
+        ephs.append(eph)
+    return ephs
+
+
+def propagate_eph(eph, toe):
+    """ the ephemeris of the same (keplerian) orbit and clock at another toe """
+    out = copy(eph)
+    dt = toe - eph.toe
+    n = np.sqrt(rCST.MU_GPS / eph.A ** 3) + eph.deln
+    out.M0 = np.mod(eph.M0 + n * dt + np.pi, 2 * np.pi) - np.pi
+    out.OMG0 = eph.OMG0 + eph.OMGd * dt
+    out.f0 = eph.f0 + eph.f1 * dt + eph.f2 * dt ** 2
+    out.f1 = eph.f1 + 2.0 * eph.f2 * dt
+    out.toe = out.toc = out.toes = toe
+    out.iode = out.iodc = (int(eph.iode) + int(round(dt / SIM_EPH_INTERVAL))) % 256
+    return out
+
+
+def constellation_store(ephs, t0, t1, interval=SIM_EPH_INTERVAL):
+    """ EphStore with the sets of ephs repeated every interval so that every
+    time of [t0, t1] is within MAXDTOE of a toe """
+    toe0 = ephs[0].toe
+    toes = toe0 + interval * np.arange(np.floor((t0 - toe0) / interval),
+                                       np.ceil((t1 - toe0) / interval) + 1)
+    return EphStore([propagate_eph(eph, toe) for toe in toes for eph in ephs])
+
+
+def static_trajectory(llh=SIM_LLH):
+    """ receiver at rest at llh (deg, deg, m) """
+    rr0 = pos2ecef(llh, True)
+
+    def trajectory(dt):
+        dt = np.asarray(dt, dtype=float)
+        return np.tile(rr0, (len(dt), 1)), np.zeros((len(dt), 3))
+    return trajectory
+
+
+def circle_trajectory(llh=SIM_LLH, radius=100.0, speed=10.0):
+    """ receiver on a horizontal circle of radius (m) about llh (deg, deg, m)
+    at constant speed (m/s) """
+    rr0 = pos2ecef(llh, True)
+    E = xyz2enu(np.array([np.deg2rad(llh[0]), np.deg2rad(llh[1]), llh[2]]))
+
+    def trajectory(dt):
+        a = np.asarray(dt, dtype=float) * speed / radius
+        enu = radius * np.stack([np.cos(a), np.sin(a), np.zeros_like(a)], axis=-1)
+        venu = speed * np.stack([-np.sin(a), np.cos(a), np.zeros_like(a)], axis=-1)
+        return rr0 + enu @ E, venu @ E
+    return trajectory
+
+
+TRAJECTORIES = {'static': static_trajectory, 'circle': circle_trajectory}
+
+
+def track_channels(visible, el, tracked, nch):
+    """ tracking mask (ne, ns) of a receiver with nch channels ------------------
+    * args   : ndarray visible  I   satellites in view at each epoch (ne, ns)
+    *          ndarray el       I   their elevations (rad) (ne, ns)
+    *          ndarray tracked  IO  satellites tracked before the first epoch
+    *                               (ns,), updated to those after the last
+    *          int   nch        I   number of channels
+    * notes  : a satellite keeps its channel until it goes out of view, free
+    *          channels take the highest visible satellites not tracked yet.
+    *          the tracked set can only change where the visibility does, so
+    *          only those epochs are evaluated """
+    ne = len(visible)
+    out = np.zeros(visible.shape, dtype=bool)
+    starts = np.flatnonzero(np.r_[True, np.any(visible[1:] != visible[:-1], axis=1)])
+    for a, b in zip(starts, np.r_[starts[1:], ne]):
+        tracked &= visible[a]
+        free = nch - tracked.sum()
+        if free > 0:
+            new = np.flatnonzero(visible[a] & ~tracked)
+            tracked[new[np.argsort(-el[a, new])[:free]]] = True
+        out[a:b] = tracked
+    return out
+
+
+def _simulate_block(all_eph, sats, trajectory, t0, week, tow, rng, opt):
+    """ observations of the epochs received at tow (ne,), as the rows and
+    offsets of an ObsStore """
+    ne = len(tow)
+    rr, rv = trajectory(tow - t0)
+    dtr = opt['clk_bias'] + opt['clk_drift'] * (tow - t0)
+    track = None
+    if opt['channels']:
+        # channels from the geometry at reception time, the full model is
+        # only evaluated for the satellites tracked in this block
+        rs, _ = satposs_batch(*np.broadcast_arrays(sats, tow[:, None]), all_eph)
+        e = rs[..., 0:3] - rr[:, None]
+        e /= norm(e, axis=-1)[..., None]
+        _, el = satazel_batch(ecef2pos_batch(rr), e)
+        visible = (el >= opt['el_mask']) & np.any(rs != 0, axis=-1)
+        track = track_channels(visible, el, opt['tracked'], opt['channels'])
+        used = track.any(axis=0)
+        sats, track = sats[used], track[:, used]
+    ns = len(sats)
+    sat = np.broadcast_to(sats, (ne, ns))
+
+    # transmission time by satellite clock: light time and clock iterations
+    tau = np.full((ne, ns), 0.075)
+    dts0 = np.zeros((ne, ns))
+    for _ in range(3):
+        tsv = tow[:, None] - tau + dts0
+        rs, dts = satposs_batch(sat, tsv, all_eph)
+        dts0 = dts[..., 0]
+        dr = rs[..., 0:3] - rr[:, None]
+        tau = norm(dr, axis=-1) / rCST.CLIGHT
+
+    # same models as the estimators (see design_matrix_batch)
+    rsp, rsv = rs[..., 0:3], rs[..., 3:6]
+    r = norm(dr, axis=-1)
+    e = dr / r[..., None]
+    rrb, rvb = rr[:, None], rv[:, None]
+    r += rCST.OMGE * (rsp[..., 0] * rrb[..., 1] - rsp[..., 1] * rrb[..., 0]) / rCST.CLIGHT
+    pos = ecef2pos_batch(rr)
+    az, el = satazel_batch(pos, e)
+    posb = pos.T[:, :, None]
+    dion = ionmodel_batch(tow[:, None], posb, az, el)
+    trop_hs, trop_wet, _ = tropmodel_batch(posb, el, REL_HUMI)
+    doy = time2doy_batch(gpst2time_batch(np.full(ne, week), tow))
+    mapfh, mapfw = tropmapf_batch(doy[:, None], posb, el)
+    idx = all_eph.select_index(sat, tsv).reshape(ne, ns)
+    tgd = all_eph.table.tgd[idx]
+    P = (r + dtr[:, None] - rCST.CLIGHT * dts0 + dion + mapfh * trop_hs + mapfw * trop_wet
+         + tgd * rCST.CLIGHT)
+    range_rate = np.sum(dr * (rsv - rvb), axis=-1) / r
+    clock_rate = opt['clk_drift'] - dts[..., 1] * rCST.CLIGHT
+    earth_correction_rate = rCST.OMGE * (rsv[..., 0] * rrb[..., 1] + rvb[..., 1] * rsp[..., 0] -
+                                         rsv[..., 1] * rrb[..., 0] - rvb[..., 0] * rsp[..., 1]) / rCST.CLIGHT
+    D = -(range_rate + clock_rate + earth_correction_rate)
+
+    # elevation dependent noise, outliers and dropouts
+    sinel = np.sin(np.maximum(el, SIM_EL_MASK))
+    P += rng.standard_normal((ne, ns)) * opt['sigma_P'] / sinel
+    D += rng.standard_normal((ne, ns)) * opt['sigma_D'] / sinel
+    for v, size in [(P, opt['outlier_P']), (D, opt['outlier_D'])]:
+        bad = rng.random((ne, ns)) < opt['p_outlier']
+        v[bad] += rng.choice([-1.0, 1.0], bad.sum()) * rng.uniform(0.2, 1.0, bad.sum()) * size
+    SNR = 30.0 + 15.0 * sinel + rng.standard_normal((ne, ns))
+    keep = (el >= opt['el_mask']) & (idx >= 0) & (rng.random((ne, ns)) >= opt['p_dropout'])
+    if track is not None:
+        keep &= track
+
+    rows = {'sat': sat[keep], 't': tsv[keep], 'week': np.full(keep.sum(), week),
+            'P': P[keep], 'corP': P[keep], 'D': D[keep], 'SNR': SNR[keep]}
+    return rows, keep.sum(axis=1), np.c_[tow, rr, rv]
+
+
+def simulate_obs(all_eph, sats=None, nsat=12, trajectory=None, rate=1.0, duration=3600.0,
+                 tow=SIM_TOW, week=SIM_WEEK, sigma_P=SIM_SIGMA_P, sigma_D=SIM_SIGMA_D,
+                 p_outlier=0.0, outlier_P=100.0, outlier_D=10.0, p_dropout=0.0,
+                 el_mask=SIM_EL_MASK, clk_bias=SIM_CLK_BIAS, clk_drift=SIM_CLK_DRIFT, seed=0):
+    """ simulate pseudorange and doppler of a receiver ----------------------
+    * args   : EphStore all_eph I   broadcast ephemerides of the satellites
+    *          ndarray sats     I   tracked satellites, each while it is above
+    *                               el_mask (default: any satellite of
+    *                               all_eph, on nsat channels, see
+    *                               track_channels)
+    *          callable trajectory I receiver (rr, rv) (n,3) ecef at time
+    *                               since start (n,), static at SIM_LLH if None
+    *          float rate, duration I epoch rate (Hz) and session length (s)
+    *          float tow, week  I   receiver time of the first epoch (gpst)
+    *          float sigma_P, sigma_D I noise at zenith (m, m/s), scaled by
+    *                               1/sin(el)
+    *          float p_outlier  I   probability of an outlier per observation,
+    *                               of 0.2..1 times outlier_P (m) / outlier_D
+    *                               (m/s) with random sign
+    *          float p_dropout  I   probability that an observation is missing
+    *          float el_mask    I   elevation mask (rad)
+    *          float clk_bias, clk_drift I receiver clock (m, m/s)
+    * return : ObsStore of the session (as read_obs_mat), truth rows (n, 7)
+    *          tow, x, y, z, vx, vy, vz of the receiver
+    * notes  : the observables follow the measurement model of
+    *          design_matrix_batch (sagnac, klobuchar, saastamoinen, TGD) so
+    *          the estimators recover the trajectory to the noise level.
+    *          D is in m/s with the sign of the FGI-GSRx exports and t is the
+    *          transmission time by satellite clock """
+    if not isinstance(all_eph, EphStore):
+        all_eph = EphStore(all_eph)
+    trajectory = trajectory or static_trajectory()
+    nepoch = int(round(duration * rate))
+    if tow + nepoch / rate >= WEEK_SEC:
+        raise ValueError("session crosses the end of gps week %d" % week)
+    channels = None
+    if sats is None:
+        # risers are acquired and setting satellites released as the
+        # visibility changes over the session
+        sats, channels = np.unique(all_eph.table.sat), nsat
+    sats = np.sort(np.asarray(sats, dtype=int))
+    opt = {'sigma_P': sigma_P, 'sigma_D': sigma_D, 'p_outlier': p_outlier,
+           'outlier_P': outlier_P, 'outlier_D': outlier_D, 'p_dropout': p_dropout,
+           'el_mask': el_mask, 'clk_bias': clk_bias, 'clk_drift': clk_drift,
+           'channels': channels, 'tracked': np.zeros(len(sats), dtype=bool)}
+    rng = np.random.default_rng(seed)
+    blocks, counts, truth = [], [], []
+    for k0 in range(0, nepoch, SIM_CHUNK):
+        t = tow + np.arange(k0, min(k0 + SIM_CHUNK, nepoch)) / rate
+        rows, count, true = _simulate_block(all_eph, sats, trajectory, tow, week, t, rng, opt)
+        blocks.append(rows)
+        counts.append(count)
+        truth.append(true)
+    offsets = np.r_[0, np.cumsum(np.concatenate(counts))] if counts else [0]
+    columns = {name: np.concatenate([b[name] for b in blocks]) if blocks else []
+               for name in ObsStore.FIELDS}
+    return ObsStore(offsets, **columns), np.concatenate(truth) if truth else np.zeros((0, 7))
+
+
+def simulate_session(nsat=12, nconst=None, rate=1.0, duration=3600.0, tow=SIM_TOW,
+                     week=SIM_WEEK, trajectory=None, seed=0, **kwargs):
+    """ constellation and observations of a synthetic session, nconst
+    satellites (default 4 * nsat, at least 24) tracked on nsat channels;
+    kwargs go to simulate_obs
+    * return : ObsStore, EphStore, truth rows (n, 7) """
+    nconst = nconst or max(4 * nsat, 24)
+    ephs = synthetic_constellation(nconst, toe=tow, week=week, seed=seed)
+    all_eph = constellation_store(ephs, tow, tow + duration)
+    all_obs, truth = simulate_obs(all_eph, nsat=nsat, trajectory=trajectory, rate=rate,
+                                  duration=duration, tow=tow, week=week, seed=seed, **kwargs)
+    return all_obs, all_eph, truth
+
+
+def save_synthetic(path, all_obs, all_eph, truth=None, obs_file='obsData.mat',
+                   eph_file='ephData.mat'):
+    """ write a synthetic session as the binary caches of obs_file and
+    eph_file in directory path (no .mat files are written, the readers of
+    read_mat and main.py use the caches directly), and the truth rows to
+    truth.npy (see resultio.read_result) """
+    os.makedirs(path, exist_ok=True)
+    columns = {name: getattr(all_obs, name) for name in ObsStore.FIELDS}
+    save_cache(os.path.join(path, obs_file), dict(columns, offsets=all_obs.offsets), source=False)
+    table = all_eph.table
+    save_cache(os.path.join(path, eph_file), {name: getattr(table, name) for name in EPH_FIELDS},
+               source=False)
+    if truth is not None:
+        np.save(os.path.join(path, 'truth.npy'), truth)
+
+
+def main(argv=None):
+    """
+    python synthetic.py out_dir [--nsat N] [--rate Hz] [--duration s]
+                        [--trajectory static|circle] [--outlier p] [--dropout p]
+    writes a dataset directory that main.py and benchmark.py --data accept
+    """
+    parser = argparse.ArgumentParser(description="synthetic GPS L1 dataset")
+    parser.add_argument('out', help="dataset directory to write")
+    parser.add_argument('--nsat', type=int, default=12, help="tracked satellites")
+    parser.add_argument('--nconst', type=int, help="constellation size (default 4 * nsat)")
+    parser.add_argument('--rate', type=float, default=1.0, help="epoch rate (Hz)")
+    parser.add_argument('--duration', type=float, default=3600.0, help="session length (s)")
+    parser.add_argument('--trajectory', default='static', choices=list(TRAJECTORIES))
+    parser.add_argument('--sigma-p', type=float, default=SIM_SIGMA_P)
+    parser.add_argument('--sigma-d', type=float, default=SIM_SIGMA_D)
+    parser.add_argument('--outlier', type=float, default=0.0, help="outlier probability")
+    parser.add_argument('--dropout', type=float, default=0.0, help="dropout probability")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    all_obs, all_eph, truth = simulate_session(
+        args.nsat, args.nconst, args.rate, args.duration,
+        trajectory=TRAJECTORIES[args.trajectory](), seed=args.seed,
+        sigma_P=args.sigma_p, sigma_D=args.sigma_d, p_outlier=args.outlier,
+        p_dropout=args.dropout)
+    save_synthetic(args.out, all_obs, all_eph, truth)
+    print("%s: %d epochs, %d observations, %d ephemerides"
+          % (args.out, len(all_obs), len(all_obs.sat), len(all_eph)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+## opt-in per-epoch instrumentation of the estimators
+
+import sys
+import json
+import time
+import numpy as np
+
+TELEMETRY_STAGES = ['satposs', 'atmos', 'design', 'solve', 'fde']
+REJECT_REASONS = ['no_eph', 'elevation', 'no_pr', 'no_doppler', 'fde']
+
+
+class Telemetry():
+    """ stage times, iterations and rejections of every epoch
+
+    disabled by default: every hook then returns at its first test, so the
+    estimators pay one attribute check per call. once started, the hooks
+    called between begin_epoch and end_epoch make up the record of that
+    epoch, which is written as one JSON line (tow, ns, iterations, nv and
+    step norm of every iteration, rejected satellites by reason, satellites
+    excluded by the fault detection, stage times in s) and folded into the
+    session summary. stage times outside an epoch (e.g. satellite states of
+    a whole session) only go to the summary. design includes atmos, the two
+    are timed where they are computed (design_matrix and AtmosCache.delays).
+
+    epochs solved together (estpos_batch) are recorded between begin_block
+    and end_block by the *_block hooks, which take the epochs (indices into
+    the block) they report on; the wall time of the block is shared equally
+    by its epochs and its stage times only go to the summary. records of
+    other processes (wls_parallel workers) are folded in by merge.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.f = None
+        self.method = None
+        self.epoch = None
+        self.block = None
+        self.records = None
+        self._reset()
+
+    def _reset(self):
+        self.nepoch = 0
+        self.wall = 0.0
+        self.times = dict.fromkeys(TELEMETRY_STAGES, 0.0)
+        self.rejects = dict.fromkeys(REJECT_REASONS, 0)
+        self.iter_hist = {}
+        self.nv_sum = 0
+        self.steps = []
+
+    def start(self, filename=None, method=None, keep=False):
+        """ enable the hooks, epoch records go to the JSON lines file
+        filename if given and, with keep, to the list records (e.g. to be
+        sent back by a worker process, see merge) """
+        self._reset()
+        self.method = method
+        self.f = open(filename, 'w') if filename else None
+        self.records = [] if keep else None
+        self.enabled = True
+
+    def stop(self):
+        """ disable the hooks, write the summary as the last line of the
+        file and return it """
+        summary = self.summary()
+        if self.f is not None:
+            self.f.write(json.dumps({'summary': summary}) + '\n')
+            self.f.close()
+            self.f = None
+        self.enabled = False
+        self.epoch = None
+        self.block = None
+        return summary
+
+    def tic(self):
+        return time.perf_counter() if self.enabled else 0.0
+
+    def toc(self, stage, tic):
+        """ add the time since tic to stage """
+        if not self.enabled:
+            return
+        dt = time.perf_counter() - tic
+        self.times[stage] += dt
+        if self.epoch is not None:
+            t = self.epoch['time']
+            t[stage] = t.get(stage, 0.0) + dt
+
+    @staticmethod
+    def _new_epoch(tow, ns):
+        return {'tow': float(tow), 'ns': int(ns), 'iter': 0, 'nv': [], 'step': [],
+                'reject': {}, 'time': {}}
+
+    def begin_epoch(self, tow, ns):
+        if not self.enabled:
+            return
+        self.epoch = self._new_epoch(tow, ns)
+        self._t0 = time.perf_counter()
+
+    def iteration(self, nv, step=None):
+        """ one iteration of the epoch with nv measurements and the norm of
+        its state update (None if no update was made) """
+        if self.epoch is None:
+            return
+        e = self.epoch
+        e['iter'] += 1
+        e['nv'].append(int(nv))
+        e['step'].append(None if step is None else float(step))
+
+    def reject(self, counts):
+        """ satellites rejected by the last measurement model build of the
+        epoch, counts maps reasons (REJECT_REASONS) to numbers """
+        if self.epoch is None:
+            return
+        fde = self.epoch['reject'].get('fde')
+        self.epoch['reject'] = {k: int(n) for k, n in counts.items() if n}
+        if fde:
+            self.epoch['reject']['fde'] = fde
+
+    def fault(self, sats):
+        """ satellites excluded by the fault detection (see raim.py) """
+        if self.epoch is None or len(sats) == 0:
+            return
+        self.epoch['fde'] = sorted(set(self.epoch.get('fde', [])) | set(map(int, sats)))
+        self.epoch['reject']['fde'] = len(self.epoch['fde'])
+
+    def end_epoch(self):
+        e = self.epoch
+        if e is None:
+            return
+        self.epoch = None
+        e['wall'] = time.perf_counter() - self._t0
+        self._fold(e)
+
+    def begin_block(self, tow, ns):
+        """ start the records of a block of epochs solved together, tow and
+        ns are (ne,) arrays """
+        if not self.enabled:
+            return
+        self.block = [self._new_epoch(t, n) for t, n in zip(tow, ns)]
+        self._t0 = time.perf_counter()
+
+    def iteration_block(self, epochs, nv, step):
+        """ one iteration of the given epochs of the block, nv and step
+        (nan where no update was made) are arrays over epochs """
+        if self.block is None:
+            return
+        for i, n, s in zip(epochs, nv, step):
+            e = self.block[i]
+            e['iter'] += 1
+            e['nv'].append(int(n))
+            e['step'].append(float(s) if np.isfinite(s) else None)
+
+    def reject_block(self, epochs, counts):
+        """ satellites rejected by the last measurement model build of the
+        given epochs of the block, counts maps reasons to arrays over epochs """
+        if self.block is None:
+            return
+        for k, i in enumerate(epochs):
+            self.block[i]['reject'] = {r: int(n[k]) for r, n in counts.items() if n[k]}
+
+    def end_block(self):
+        block = self.block
+        if block is None:
+            return
+        self.block = None
+        wall = (time.perf_counter() - self._t0) / max(len(block), 1)
+        for e in block:
+            e['wall'] = wall
+            self._fold(e)
+
+    def merge(self, records, times):
+        """ fold the epoch records and stage times of another instance
+        (e.g. of a worker process, started with keep) into this one """
+        if not self.enabled:
+            return
+        for e in records:
+            self._fold(e)
+        for stage, t in times.items():
+            self.times[stage] += t
+
+    def _fold(self, e):
+        """ add a finished epoch record to the summary and the outputs """
+        self.nepoch += 1
+        self.wall += e['wall']
+        self.iter_hist[e['iter']] = self.iter_hist.get(e['iter'], 0) + 1
+        self.nv_sum += e['nv'][-1] if e['nv'] else 0
+        for k, n in e['reject'].items():
+            self.rejects[k] += n
+        steps = [s for s in e['step'] if s is not None]
+        if steps:
+            self.steps.append(steps[-1])
+        if self.f is not None:
+            self.f.write(json.dumps(e) + '\n')
+        if self.records is not None:
+            self.records.append(e)
+
+    def summary(self):
+        """ totals of the epochs recorded since start """
+        n = max(self.nepoch, 1)
+        iters = sorted(self.iter_hist.items())
+        steps = np.array(self.steps)
+        return {
+            'method': self.method,
+            'epochs': self.nepoch,
+            'wall': self.wall,
+            'time': dict(self.times),
+            'iter_mean': sum(k * c for k, c in iters) / n,
+            'iter_max': iters[-1][0] if iters else 0,
+            'iter_hist': {str(k): c for k, c in iters},
+            'nv_mean': self.nv_sum / n,
+            'reject': dict(self.rejects),
+            'step_median': float(np.median(steps)) if len(steps) else None,
+            'step_max': float(steps.max()) if len(steps) else None,
+        }
+
+
+TELEMETRY = Telemetry()  # the instance the estimators report to
+
+
+def summary_table(summary):
+    """ text table of a summary (see Telemetry.summary) """
+    n = max(summary['epochs'], 1)
+    lines = ["%s: %d epochs, %.3f s in epochs" % (summary['method'] or '-', summary['epochs'],
+                                                  summary['wall'])]
+    lines.append("%-12s %10s %12s %8s" % ('stage', 'total s', 'ms/epoch', 'share'))
+    for stage, t in summary['time'].items():
+        share = t / summary['wall'] * 100 if summary['wall'] > 0 else 0.0
+        lines.append("%-12s %10.3f %12.4f %7.1f%%" % (stage, t, t / n * 1e3, share))
+    lines.append("iterations   mean %.2f max %d  histogram %s"
+                 % (summary['iter_mean'], summary['iter_max'],
+                    ' '.join('%s:%d' % kv for kv in summary['iter_hist'].items())))
+    lines.append("nv           mean %.1f" % summary['nv_mean'])
+    lines.append("rejected     " + ' '.join('%s:%d' % kv for kv in summary['reject'].items()))
+    if summary['step_median'] is not None:
+        lines.append("last step    median %.3g max %.3g" % (summary['step_median'],
+                                                            summary['step_max']))
+    return '\n'.join(lines)
+
+
+def read_telemetry(filename):
+    """ epoch records and summary (None if the run did not finish) of a
+    telemetry file """
+    epochs, summary = [], None
+    with open(filename) as f:
+        for line in f:
+            rec = json.loads(line)
+            if 'summary' in rec:
+                summary = rec['summary']
+            else:
+                epochs.append(rec)
+    return epochs, summary
+
+
+if __name__ == '__main__':
+    # python telemetry.py file.jsonl ...: summary tables of telemetry files
+    for filename in sys.argv[1:]:
+        print(summary_table(read_telemetry(filename)[1]))
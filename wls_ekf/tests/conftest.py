@@ -0,0 +1,20 @@
+## shared fixtures of the tests, run with python -m pytest from wls_ekf
+
+import os
+import sys
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+from read_mat import *
+
+OPENSKY = os.path.join(os.path.dirname(TEST_DIR), 'data', 'Opensky')
+
+
+@pytest.fixture(scope='session')
+def opensky():
+    """ observations and ephemerides of the Opensky dataset, parsed without
+    touching its binary cache """
+    return (read_obs_mat(os.path.join(OPENSKY, 'obsData.mat'), use_cache=False),
+            read_eph_mat(os.path.join(OPENSKY, 'ephData.mat'), use_cache=False))
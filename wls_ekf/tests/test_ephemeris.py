@@ -0,0 +1,24 @@
+import numpy as np
+from ephemeris import *
+
+
+def test_vel_diff_matches_analytic(opensky):
+    all_obs, all_eph = opensky
+    obs = all_obs[100]
+    rs, dts = satposs(obs, all_eph)
+    rs_d, dts_d = satposs(obs, all_eph, mode=VEL_DIFF)
+    assert np.array_equal(rs_d[:, 0:3], rs[:, 0:3])
+    assert np.array_equal(dts_d[:, 0], dts[:, 0])
+    np.testing.assert_allclose(rs_d[:, 3:6], rs[:, 3:6], atol=1e-3)
+    np.testing.assert_allclose(dts_d[:, 1], dts[:, 1], atol=1e-12)
+
+
+def test_vel_diff_scalar_matches_batch(opensky):
+    all_obs, all_eph = opensky
+    obs = all_obs[100]
+    t = obs.t[0]
+    eph = seleph(obs.sat[0], all_eph, t)
+    rs, dts = ephpos(t, eph, VEL_DIFF)
+    rs_b, dts_b = ephpos_batch(np.array([t]), stack_eph([eph]), VEL_DIFF)
+    np.testing.assert_allclose(rs_b[0], rs, rtol=0, atol=1e-6)
+    np.testing.assert_allclose(dts_b[0], dts, rtol=0, atol=1e-15)
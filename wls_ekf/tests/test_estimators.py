@@ -0,0 +1,112 @@
+import numpy as np
+from numpy.linalg import norm
+from synthetic import simulate_session, save_synthetic
+from design import design_matrix, design_matrix_batch, epoch_tgd
+from ephemeris import satposs, satposs_batch
+from raim import chi2_threshold, fde_wls, fde_innovation
+from telemetry import TELEMETRY
+from wls import lst, lst_batch, estpos, estpos_batch, iter_wls, WLS_pos_vel_estimation
+from ekf import iter_ekf
+
+
+def _session(**kwargs):
+    return simulate_session(nsat=10, rate=1.0, duration=60.0, seed=1, **kwargs)
+
+
+def test_design_matrix_matches_batch(opensky):
+    all_obs, all_eph = opensky
+    obs = all_obs[100]
+    rs, dts = satposs(obs, all_eph)
+    x, _, _ = estpos(len(obs.sat), obs, all_eph, rs, dts)
+    tgd = epoch_tgd(obs, all_eph)
+    for it in (0, 1):
+        nv, v, H, w = design_matrix(it, obs, all_eph, rs, dts, x, tgd)
+        nvb, vb, Hb, wb, mask = design_matrix_batch(it, all_obs.pack([100]), rs[None], dts[None],
+                                                    x[None], tgd[None])
+        assert nv == nvb[0]
+        np.testing.assert_allclose(v, vb[0][mask[0]], atol=1e-6)
+        np.testing.assert_allclose(H, Hb[0][mask[0]], atol=1e-12)
+        np.testing.assert_allclose(w, wb[0][mask[0]], rtol=1e-12)
+
+
+def test_lst_matches_batch():
+    rng = np.random.default_rng(0)
+    H, v, w = rng.standard_normal((3, 20, 8)), rng.standard_normal((3, 20)), rng.uniform(1, 2, (3, 20))
+    dxb, Qb = lst_batch(H, w, v)
+    for i in range(3):
+        dx, Q = lst(H[i], w[i], v[i])
+        np.testing.assert_allclose(dxb[i], dx, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(Qb[i], Q, rtol=1e-10, atol=1e-12)
+
+
+def test_estpos_batch_matches_serial():
+    all_obs, all_eph, truth = _session()
+    serial = np.array(list(iter_wls(all_obs, all_eph)))
+    packed = all_obs.pack()
+    rs, dts = satposs_batch(packed.sat, packed.t, all_eph)
+    x, _, _ = estpos_batch(packed, all_eph, rs, dts)
+    np.testing.assert_allclose(x[:, 0:3], serial[:, 1:4], atol=1e-4)
+    assert np.sqrt(np.mean(norm(serial[:, 1:4] - truth[:, 1:4], axis=1) ** 2)) < 20.0
+
+
+def test_parallel_matches_serial(tmp_path):
+    all_obs, all_eph, _ = _session()
+    save_synthetic(str(tmp_path), all_obs, all_eph)
+    obs_file, eph_file = str(tmp_path / 'obsData.mat'), str(tmp_path / 'ephData.mat')
+    serial = WLS_pos_vel_estimation(obs_file, eph_file)
+    parallel = WLS_pos_vel_estimation(obs_file, eph_file, workers=1, chunk_size=25)
+    assert np.array_equal(np.array(parallel), np.array(serial))
+
+
+def test_stream_matches_session_ekf():
+    all_obs, all_eph, _ = _session()
+    session = list(iter_ekf(all_obs, all_eph))
+    stream = list(iter_ekf(iter(all_obs), all_eph))
+    np.testing.assert_allclose(stream, session, atol=1e-6)
+
+
+def test_chi2_threshold():
+    # chi-square quantiles of 1 - 1e-3
+    np.testing.assert_allclose([chi2_threshold(1), chi2_threshold(2), chi2_threshold(10)],
+                               [10.828, 13.816, 29.588], atol=1e-3)
+
+
+def test_fde_wls_downdate_matches_refit():
+    all_obs, all_eph, _ = _session()
+    obs = all_obs[30]
+    obs.P = obs.P.copy()
+    obs.P[2] += 300.0
+    rs, dts = satposs(obs, all_eph)
+    x, _, _ = estpos(len(obs.sat), obs, all_eph, rs, dts)
+    nv, v, H, w, sat = design_matrix(1, obs, all_eph, rs, dts, x, sats=True)
+    dx, Q = lst(H, w, v)
+    dx_fde, Q_fde, excluded, _, passed = fde_wls(H, w, v - H @ dx, Q, sat)
+    assert list(excluded) == [2] and passed
+    keep = sat != 2
+    dx_ref, Q_ref = lst(H[keep], w[keep], v[keep])
+    np.testing.assert_allclose(dx + dx_fde, dx_ref, atol=1e-6)
+    np.testing.assert_allclose(Q_fde, Q_ref, rtol=1e-8, atol=1e-10)
+
+
+def test_fde_excludes_a_faulty_satellite():
+    all_obs, all_eph, truth = _session()
+    k = 30
+    bad = all_obs.sat[all_obs.offsets[k] + 3]
+    all_obs.P = all_obs.P.copy()
+    all_obs.P[all_obs.offsets[k] + 3] += 300.0
+    TELEMETRY.start(keep=True)
+    try:
+        rows = [list(iter_wls(all_obs, all_eph, fde=fde)) for fde in (False, True)]
+        records = TELEMETRY.records
+    finally:
+        TELEMETRY.stop()
+    assert records[len(all_obs) + k].get('fde') == [bad]
+    err = [norm(np.array(r[k][1:4]) - truth[k, 1:4]) for r in rows]
+    assert err[1] < err[0] and err[1] < 30.0
+
+
+def test_fde_innovation_excludes_the_outlier():
+    y = np.array([0.5, -0.3, 20.0, 20.0, 0.1, -0.8, 0.2, 0.4])
+    sat = np.array([1, 1, 2, 2, 3, 3, 4, 4])
+    excluded, T, passed = fde_innovation(y, np.eye(8), sat)
+    assert excluded == [2] and passed
@@ -0,0 +1,45 @@
+import os
+import shutil
+import numpy as np
+from conftest import OPENSKY
+from read_mat import *
+
+
+COLUMNS = list(ObsStore.FIELDS) + ['offsets']
+
+
+def test_obs_cache_matches_parse(tmp_path):
+    mat = str(tmp_path / 'obsData.mat')
+    shutil.copy(os.path.join(OPENSKY, 'obsData.mat'), mat)
+    ref = ObsStore.from_epochs(parse_obs_mat(mat))
+    store = read_obs_mat(mat)
+    assert load_cache(mat) is not None
+    for name in COLUMNS:
+        a, b = getattr(store, name), getattr(ref, name)
+        assert a.dtype == b.dtype and np.array_equal(a, b)
+    # block boundaries do not show in the cache
+    assert save_cache_blocks(mat, obs_blocks(parse_obs_mat(mat), 7))
+    blocks = ObsStore(**load_cache(mat))
+    for name in COLUMNS:
+        assert np.array_equal(getattr(blocks, name), getattr(ref, name))
+    assert np.array_equal(next(iter_obs_mat(mat)).P, ref[0].P)
+
+
+def test_cache_is_invalidated_by_a_changed_source(tmp_path):
+    mat = str(tmp_path / 'ephData.mat')
+    shutil.copy(os.path.join(OPENSKY, 'ephData.mat'), mat)
+    all_eph = read_eph_mat(mat)
+    assert load_cache(mat) is not None
+    st = os.stat(mat)
+    os.utime(mat, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert load_cache(mat) is None
+    # read again from the .mat file and cached anew
+    assert len(read_eph_mat(mat)) == len(all_eph)
+    assert load_cache(mat) is not None
+
+
+def test_cache_without_source(tmp_path):
+    mat = str(tmp_path / 'obsData.mat')
+    save_cache(mat, {'a': np.arange(5.0)}, source=False)
+    assert not os.path.exists(mat) and dataset_file_exists(mat)
+    assert np.array_equal(load_cache(mat)['a'], np.arange(5.0))
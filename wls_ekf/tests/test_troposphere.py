@@ -0,0 +1,29 @@
+import warnings
+import numpy as np
+from troposphere import *
+
+
+def test_tropmodel_batch_matches_scalar():
+    pos = (0.4, 2.0, 500.0)
+    el = np.array([0.2, 0.5, 1.2])
+    hs, wet, z = tropmodel_batch(pos, el, 0.7)
+    for i in range(len(el)):
+        np.testing.assert_allclose((hs[i], wet[i], z[i]), tropmodel(pos, el[i], 0.7))
+
+
+def test_out_of_range_rows_are_zero_without_warnings():
+    # below the horizon, above/below the model heights and the height
+    # where the standard atmosphere temperature reaches the pole of exp
+    hgt = np.array([800.0, 800.0, 38417.4, 1e5, -500.0, -1e7])
+    el = np.array([0.0, -0.3, 0.5, 0.5, 0.5, 0.5])
+    pos = (np.full(len(hgt), 0.4), np.full(len(hgt), 2.0), hgt)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        hs, wet, z = tropmodel_batch(pos, el, 0.7)
+        mapfh, mapfw = tropmapf_batch(100.0, pos, el)
+    for a in (hs, wet, z):
+        assert np.all(a == 0)
+    # the mapping function allows down to -1 km
+    out = np.arange(len(hgt)) != 4
+    assert np.all(mapfh[out] == 0) and np.all(mapfw[out] == 0)
+    assert mapfh[4] > 0 and mapfw[4] > 0
@@ -6,7 +6,7 @@ url: https://github.com/rtklibexplorer/rtklib-py
 """
 
 import numpy as np
-from gnsscommon import time2doy, interpc
+from gnsscommon import time2doy, interpc_batch
 
 # troposhere model
 nmf_coef = np.array([
@@ -29,32 +29,46 @@ def mapf(el, a, b, c):
 
 def tropmapf(t, pos, el):
     """ tropospheric mapping function Neil (NMF)  """
-    if pos[2] < -1e3 or pos[2] > 20e3 or el <= 0.0:
-        return 0.0, 0.0
+    mapfh, mapfw = tropmapf_batch(time2doy(t), pos, el)
+    return float(mapfh), float(mapfw)
 
+
+def tropmodel(pos, el, humi):
+    """ saastamonien tropospheric delay model """
+    trop_hs, trop_wet, z = tropmodel_batch(pos, el, humi)
+    return float(trop_hs), float(trop_wet), float(z)
+
+
+def tropmapf_batch(doy, pos, el):
+    """ array version of tropmapf, doy is the day of year of the epoch
+    * pos[i] and doy may be arrays that broadcast against el """
+    el = np.asarray(el, dtype=float)
     aht = nmf_aht
     lat = np.rad2deg(pos[0])
     # year from doy 28, add half a year for southern latitudes
-    y = (time2doy(t) - 28.0) / 365.25
-    y += 0.5 if lat < 0 else 0
+    y = (doy - 28.0) / 365.25
+    y = y + np.where(lat < 0, 0.5, 0)
     cosy = np.cos(2.0 * np.pi * y)
-    c = interpc(nmf_coef, np.abs(lat))
+    c = interpc_batch(nmf_coef, np.abs(lat))
     ah = c[0:3] - c[3:6] * cosy
     aw = c[6:9]
     # ellipsoidal height is used instead of height above sea level
-    dm = (1.0 / np.sin(el) - mapf(el, aht[0], aht[1], aht[2])) * pos[2] * 1e-3
-    mapfh = mapf(el, ah[0], ah[1], ah[2]) + dm
-    mapfw = mapf(el, aw[0], aw[1], aw[2])
-
-    return mapfh, mapfw
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dm = (1.0 / np.sin(el) - mapf(el, aht[0], aht[1], aht[2])) * pos[2] * 1e-3
+        mapfh = mapf(el, ah[0], ah[1], ah[2]) + dm
+        mapfw = mapf(el, aw[0], aw[1], aw[2])
+    valid = (pos[2] >= -1e3) & (pos[2] <= 20e3) & (el > 0.0)
+    return np.where(valid, mapfh, 0.0), np.where(valid, mapfw, 0.0)
 
 
-def tropmodel(pos, el, humi):
-    """ saastamonien tropospheric delay model """
+def tropmodel_batch(pos, el, humi):
+    """ array version of tropmodel, pos[i] may be arrays that broadcast
+    against el """
     temp0 = 15  # temparature at sea level
-    if pos[2] < -100 or pos[2] > 1e4 or el <= 0:
-        return 0, 0, 0
-    hgt = max(pos[2], 0)
+    el = np.asarray(el, dtype=float)
+    # heights outside the model give no delay (see valid), clamped so that
+    # the standard atmosphere stays finite on those rows too
+    hgt = np.clip(pos[2], 0, 1e4)
     # standard atmosphere
     pres = 1013.25 * np.power(1 - 2.2557e-5 * hgt, 5.2568)
     temp = temp0 - 6.5e-3 * hgt + 273.16
@@ -64,4 +78,5 @@ def tropmodel(pos, el, humi):
     trop_hs = 0.0022768 * pres / (1.0 - 0.00266 * np.cos(2 * pos[0]) -
                                   0.00028e-3 * hgt) / np.cos(z)
     trop_wet = 0.002277 * (1255.0 / temp + 0.05) * e / np.cos(z)
-    return trop_hs, trop_wet, z
+    valid = (pos[2] >= -100) & (pos[2] <= 1e4) & (el > 0)
+    return np.where(valid, trop_hs, 0), np.where(valid, trop_wet, 0), np.where(valid, z, 0)
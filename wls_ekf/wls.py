@@ -4,120 +4,209 @@ from gnsscommon import *
 from ionosphere import *
 from troposphere import *
 from read_mat import *
+from orbitcache import *
+from design import *
+from raim import *
 
 
 MAXITR =    10          #  max number of iteration or point pos
-REL_HUMI =  0.7         #  relative humidity for Saastamoinen model
-MIN_EL = np.deg2rad(5)  #  min elevation for measurement
 
 
-def design_wetight_matrix_wls(iter, ns, obs, eph, rs, dts, x):
+def design_wetight_matrix_wls(iter, ns, obs, eph, rs, dts, x, tgd=None, atmos=None, sats=False):
     """
     prange and doppler
 
+    return nv, v, H and the diagonal of the weight matrix as a vector (and
+    the satellite of every row with sats=True)
+    """
+    return design_matrix(iter, obs, eph, rs, dts, x, tgd, atmos, sats=sats)
+
+def lst(H, w, v):
+    """
+    weighted least squares with diagonal weights w
+
+    the rows are scaled by sqrt(w) and the augmented rows [A b] are
+    factorized by QR, which gives R and Q_A' b at once, so neither the
+    normal matrix A'A = R'R nor Q_A is formed: dx solves R dx = Q_A' b by
+    back substitution and the covariance Q = (H' W H)^-1 = R^-1 R^-T comes
+    from the triangular inverse of R
+    """
+    from scipy.linalg import lapack  # slow import, paid at the first solve
+    sw = np.sqrt(w)
+    n = H.shape[1]
+    Rb = np.linalg.qr(np.hstack([H * sw[:, None], (v * sw)[:, None]]), mode='r')
+    R = Rb[:n, :n]
+    dx, info = lapack.dtrtrs(R, Rb[:n, n])
+    R_inv, info_inv = lapack.dtrtri(R)
+    if info != 0 or info_inv != 0:
+        raise np.linalg.LinAlgError("rank deficient design matrix")
+    return dx, R_inv @ R_inv.T
+
+def estpos(ns, obs, eph, rs, dts, fde=False):
+    """ estimate position and clock errors with standard precision
+
+    with fde the converged solution goes through the RAIM chi-square test
+    and faulty satellites are excluded by downdates of the last solve (see
+    raim.fde_wls), even if later iterations had too few measurements.
+    return x, the covariance Q of the last update and the weighted DOPs
+    (gdop, pdop, hdop, vdop) derived from it
     """
-    v = np.zeros(ns * 2)
-    H = np.zeros([ns * 2, 8])
-    P = np.zeros([ns * 2, ns * 2])
-
-    rr = x[0:3]
-    rv = x[4:7]
-    dtr = x[3]
-    dtrv = x[7]
-    pos = ecef2pos(rr)
-    nv = 0
-
-    for i in range(ns):
-        if norm(rs[i, :3]) < rCST.RE_WGS84:
-            continue
-        r, e = geodist(rs[i, :3], rr)
-        ev = geodist_v(rs[i, 3:6], rv, r)
-        if r < 0:
-            continue
-        [az, el] = satazel(pos, e)
-        if el < MIN_EL:
-            continue
-        if iter > 0:
-            # ionospheric correction
-            dion = ionmodel(obs.t[0], pos, az, el)
-            # tropospheric correction
-            trop_hs, trop_wet, _ = tropmodel(pos, el, REL_HUMI)
-            mapfh, mapfw = tropmapf(gpst2time(obs.week[i], obs.t[i]), pos, el)
-            dtrp = mapfh * trop_hs + mapfw * trop_wet
-        else:
-            dion = dtrp = 0
-        # TGD correction
-        if obs.P[i] == 0:
-            continue
-        tmp_eph = seleph(obs.sat[i], eph)
-        p_range = obs.P[i] - tmp_eph.tgd * rCST.CLIGHT
-        # pseudorange residual
-        v[nv] = p_range - (r + dtr - rCST.CLIGHT * dts[i,0] + dion + dtrp)
-        # design matrix
-        H[nv, 0:3] = -e
-        H[nv, 3] = 1
-        # weight matrix
-        P[nv, nv] = get_weight_based_elevation(el)
-        nv += 1
-        # Doppler measurement
-        if obs.D[i] == 0:
-            continue
-        doppler_measurement = -obs.D[i] #* rCST.CLIGHT / rCST.GPS_L1_FREQ
-        # range rate
-        range_rate = np.sum((rs[i,:3] - rr) * (rs[i,3:] - rv)) / r
-        # clock rate
-        clock_rate = dtrv - dts[i,1] * rCST.CLIGHT
-        # earth correction rate
-        earth_correction_rate = rCST.OMGE * (rs[i,3] * rr[1] + rv[1] * rs[i,0] - rs[i,4] * rr[0] - rv[0] * rs[i,1]) / rCST.CLIGHT
-        H[nv, 0] = -ev[0] + e[0] * (e[0] * ev[0] + e[1] * ev[1] + e[2] * ev[2])
-        H[nv, 1] = -ev[1] + e[1] * (e[0] * ev[0] + e[1] * ev[1] + e[2] * ev[2])
-        H[nv, 2] = -ev[2] + e[2] * (e[0] * ev[0] + e[1] * ev[1] + e[2] * ev[2])
-        H[nv, 4:7] = -e
-        H[nv, 7] = 1
-        v[nv] = doppler_measurement - (range_rate + clock_rate + earth_correction_rate)
-        P[nv, nv] = P[nv-1, nv-1] * 5
-        nv += 1
-    return nv, v, H, P
-
-def lst(H, P, v):
-    H_T = H.T
-    HTPH = H_T @ P @ H
-    HTPH_inv = np.linalg.inv(HTPH)
-    HTPv = H_T @ P @ v
-    dx = HTPH_inv @ HTPv
-    return dx
-
-def estpos(ns, obs, eph, rs, dts):
-    """ estimate position and clock errors with standard precision """
     x = np.zeros(8)
-    v = np.zeros(ns * 2)
-    H = np.zeros([ns * 2, 8])
-    P = np.zeros([ns * 2, ns * 2])
+    Q = np.zeros((8, 8))
+    tgd = epoch_tgd(obs, eph)
+    atmos = epoch_atmos(obs)
+    fit = None
     for iter in range(MAXITR):
-        nv, v, H, P = design_wetight_matrix_wls(iter, ns, obs, eph, rs, dts, x)
+        nv, v, H, w, sat = design_wetight_matrix_wls(iter, ns, obs, eph, rs, dts, x, tgd,
+                                                     atmos, sats=True)
         if nv < 8:
+            TELEMETRY.iteration(nv)
             continue
-        v1 = v[:nv]
-        H1 = H[:nv, :8]
-        P1 = P[:nv, :nv]
-        dx = lst(H1, P1, v1)
+        tic = TELEMETRY.tic()
+        dx, Q = lst(H, w, v)
+        TELEMETRY.toc('solve', tic)
         x += dx
+        TELEMETRY.iteration(nv, norm(dx))
+        if fde:
+            # design and residuals of the last solve, for the test
+            fit = (H, w, v - H @ dx, Q, sat)
         if norm(dx) < 1e-4:
             break
+    if fit is not None:
+        tic = TELEMETRY.tic()
+        dx, Q, excluded, _, _ = fde_wls(*fit)
+        x += dx
+        TELEMETRY.toc('fde', tic)
+        TELEMETRY.fault(np.asarray(obs.sat)[excluded])
+    dop = cov2dop(Q, ecef2pos(x[0:3]))
+    return x, Q, dop
+
+def solve_upper_batch(R, b):
+    """ back substitution R x = b for a stack of upper triangular R
+    (ne, n, n) and right-hand sides b (ne, n, k), one row at a time over
+    all epochs """
+    x = np.zeros_like(b)
+    for i in range(R.shape[1] - 1, -1, -1):
+        x[:, i] = (b[:, i] - np.sum(R[:, i, i + 1:, None] * x[:, i + 1:], axis=1)) / R[:, i, i, None]
     return x
 
-def WLS_pos_vel_estimation(obs_filename, eph_filename):
-    out = []
-    x = np.zeros(8)
+def lst_batch(H, w, v):
+    """
+    batched version of lst for a stack of epochs, H (ne, nv, 8), w and v
+    (ne, nv); rows with zero weight do not contribute
+    """
+    sw = np.sqrt(w)
+    n = H.shape[2]
+    Rb = np.linalg.qr(np.concatenate([H * sw[..., None], (v * sw)[..., None]], axis=2),
+                      mode='r')
+    R = Rb[:, :n, :n]
+    dx = solve_upper_batch(R, Rb[:, :n, n:])[..., 0]
+    R_inv = solve_upper_batch(R, np.broadcast_to(np.eye(n), R.shape))
+    Q = R_inv @ np.swapaxes(R_inv, 1, 2)
+    return dx, Q
+
+def estpos_batch(obs, eph, rs, dts):
+    """ estimate position and clock errors of a block of epochs at once
+
+    obs is an Obs with (ne, ns) array fields (see pack_obs), rs and dts as
+    returned by satposs_batch for it. every epoch is iterated as in estpos
+    but all epochs share one batched Gauss-Newton step; an epoch drops out
+    of later iterations once its own update converged. the iterations and
+    rejections of every epoch go to the telemetry as a block (see
+    Telemetry.begin_block).
+
+    return x (ne, 8), Q (ne, 8, 8) and the weighted DOPs (ne, 4)
+    """
+    ne = len(obs.P)
+    x = np.zeros((ne, 8))
+    Q = np.zeros((ne, 8, 8))
+    tgd = epoch_tgd(obs, eph)
+    atmos = AtmosCache(obs)
+    active = np.arange(ne)
+    TELEMETRY.begin_block(obs.t[:, 0], np.sum(np.asarray(obs.sat) != 0, axis=1))
+    for iter in range(MAXITR):
+        if len(active) == 0:
+            break
+        sub = Obs()
+        for name in ['sat', 't', 'week', 'P', 'D']:
+            setattr(sub, name, getattr(obs, name)[active])
+        nv, v, H, w, _ = design_matrix_batch(iter, sub, rs[active], dts[active],
+                                             x[active], tgd[active], atmos, active)
+        # epochs with too few measurements wait for the next iteration
+        ok = nv >= 8
+        tic = TELEMETRY.tic()
+        dx, Q[active[ok]] = lst_batch(H[ok], w[ok], v[ok])
+        TELEMETRY.toc('solve', tic)
+        x[active[ok]] += dx
+        step = np.full(len(active), np.nan)
+        step[ok] = norm(dx, axis=1)
+        TELEMETRY.iteration_block(active, nv, step)
+        active = active[~(step < 1e-4)]
+    TELEMETRY.end_block()
+    dop = np.array([cov2dop(Qi, pos) for pos, Qi in zip(ecef2pos_batch(x[:, 0:3]), Q)])
+    return x, Q, dop
+
+def WLS_pos_vel_estimation(obs_filename, eph_filename, batch=False, workers=0, chunk_size=100,
+                           fde=False):
+    """
+    WLS position and velocity of every epoch with at least 4 satellites
+
+    with batch=True all epochs of the session are solved together by
+    estpos_batch instead of one estpos call per epoch. with workers > 0
+    chunks of chunk_size epochs are solved on a process pool (see
+    wls_parallel), the output is identical to the serial path; the two
+    are alternatives. fde (fault detection and exclusion, see estpos)
+    needs the serial per-epoch path
+    """
+    if fde and (batch or workers > 0):
+        raise ValueError("fde is only done by the serial per-epoch solver")
+    if batch and workers > 0:
+        raise ValueError("batch and workers are alternative solvers")
+    if workers > 0:
+        from wls_parallel import WLS_pos_vel_estimation_parallel
+        return WLS_pos_vel_estimation_parallel(obs_filename, eph_filename, workers, chunk_size)
     all_obs = read_obs_mat(obs_filename)
     all_eph = read_eph_mat(eph_filename)
-    for i in range(len(all_obs)):
-        obs = all_obs[i]
+    if batch:
+        packed = all_obs.pack(np.flatnonzero(all_obs.nsat >= 4))
+        tic = TELEMETRY.tic()
+        rs, dts = satposs_batch(packed.sat, packed.t, all_eph)
+        TELEMETRY.toc('satposs', tic)
+        x, _, _ = estpos_batch(packed, all_eph, rs, dts)
+        return [[t, xi[0], xi[1], xi[2], xi[4], xi[5], xi[6]]
+                for t, xi in zip(packed.t[:, 0], x)]
+    return list(iter_wls(all_obs, all_eph, fde=fde))
+
+def iter_wls(all_obs, all_eph, orbit=None, fde=False):
+    """ WLS result row of each epoch of the iterable all_obs, yielded as
+    soon as the epoch is solved. for an ObsStore the satellite states of
+    all epochs are computed in one pass and sliced per epoch """
+    session = isinstance(all_obs, ObsStore)
+    if session:
+        tic = TELEMETRY.tic()
+        rs_all, dts_all = satposs_batch(all_obs.sat, all_obs.t, all_eph, orbit=orbit)
+        TELEMETRY.toc('satposs', tic)
+    for i, obs in enumerate(all_obs):
         ns = len(obs.sat)
         if ns < 4:
             continue
-        rs, dts = satposs(obs, all_eph)
-        x = estpos(ns, obs, all_eph, rs, dts)
-        out.append([obs.t[0], x[0], x[1], x[2], x[4], x[5], x[6]])
-    return out
+        TELEMETRY.begin_epoch(obs.t[0], ns)
+        if session:
+            a, b = all_obs.offsets[i], all_obs.offsets[i + 1]
+            rs, dts = rs_all[a:b], dts_all[a:b]
+        else:
+            tic = TELEMETRY.tic()
+            rs, dts = satposs(obs, all_eph, orbit=orbit)
+            TELEMETRY.toc('satposs', tic)
+        x, _, _ = estpos(ns, obs, all_eph, rs, dts, fde)
+        TELEMETRY.end_epoch()
+        yield [obs.t[0], x[0], x[1], x[2], x[4], x[5], x[6]]
 
+def WLS_pos_vel_stream(obs_filename, eph_filename, fde=False, orbit_cache_dir=None):
+    """ streaming WLS: epochs are read lazily and results are yielded one
+    by one, nothing is accumulated over the session. with orbit_cache_dir
+    the satellite states of every epoch are interpolated from Chebyshev
+    fits persisted there (see OrbitCache) """
+    all_eph = read_eph_mat(eph_filename)
+    orbit = OrbitCache(all_eph, cache_dir=orbit_cache_dir) if orbit_cache_dir else None
+    return iter_wls(iter_obs_mat(obs_filename), all_eph, orbit, fde)
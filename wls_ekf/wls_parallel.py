@@ -0,0 +1,113 @@
+## process-pool parallel WLS over chunks of epochs
+
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from wls import *
+
+CHUNK_SIZE = 100  # epochs per task
+
+# arrays attached by each worker process, see _init_worker
+_shared = {}
+
+
+def _to_shared(arrays):
+    """ copy arrays into shared memory blocks, return blocks and specs """
+    blocks, specs = [], {}
+    for name, a in arrays.items():
+        a = np.ascontiguousarray(a)
+        shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+        np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+        blocks.append(shm)
+        specs[name] = (shm.name, a.shape, a.dtype.str)
+    return blocks, specs
+
+
+def _init_worker(specs):
+    """ attach the shared observation and ephemeris arrays (no copies),
+    the ephemeris store works on the shared table directly """
+    _shared.clear()
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    table = Eph()
+    for name in EPH_FIELDS + EPH_DERIVED:
+        setattr(table, name, _shared['eph_' + name][1])
+    _shared['all_eph'] = EphStore.from_table(table)
+    _shared['all_obs'] = ObsStore(_shared['obs_offsets'][1],
+                                  **{name: _shared['obs_' + name][1] for name in ObsStore.FIELDS})
+
+
+def _wls_chunk(start, stop, telemetry=False):
+    """ WLS of epochs [start, stop) exactly as the serial loop does it;
+    with telemetry the epoch records and stage times of the chunk are
+    returned too, for the parent to merge (see Telemetry.merge) """
+    all_obs = _shared['all_obs'].slice(start, stop)
+    if not telemetry:
+        return list(iter_wls(all_obs, _shared['all_eph'])), None
+    TELEMETRY.start(keep=True)
+    try:
+        rows = list(iter_wls(all_obs, _shared['all_eph']))
+        return rows, (TELEMETRY.records, dict(TELEMETRY.times))
+    finally:
+        TELEMETRY.stop()
+
+
+def WLS_pos_vel_estimation_parallel(obs_filename, eph_filename, workers=None,
+                                    chunk_size=CHUNK_SIZE):
+    """
+    WLS_pos_vel_estimation on a process pool
+
+    the epochs are split into chunks of chunk_size epochs which are solved
+    by workers (default: one per cpu). observations and ephemerides are
+    placed in shared memory once and attached by every worker instead of
+    being pickled per task. chunks are reassembled in epoch order, so the
+    output is identical to the serial path. when the telemetry is on, the
+    epoch records of the workers are merged into it in epoch order
+    """
+    all_obs = read_obs_mat(obs_filename)
+    all_eph = read_eph_mat(eph_filename)
+    arrays = {'obs_' + name: getattr(all_obs, name) for name in ObsStore.FIELDS}
+    arrays['obs_offsets'] = all_obs.offsets
+    table = all_eph.table
+    for name in EPH_FIELDS + EPH_DERIVED:
+        arrays['eph_' + name] = getattr(table, name)
+    blocks, specs = _to_shared(arrays)
+    try:
+        starts = list(range(0, len(all_obs), chunk_size))
+        stops = [min(s + chunk_size, len(all_obs)) for s in starts]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(specs,)) as pool:
+            out = []
+            telemetry = [TELEMETRY.enabled] * len(starts)
+            for rows, records in pool.map(_wls_chunk, starts, stops, telemetry):
+                out.extend(rows)
+                if records is not None:
+                    TELEMETRY.merge(*records)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    return out
+
+
+def wls_speedup_curve(obs_filename, eph_filename, workers=(1, 2, 4, 8),
+                      chunk_size=CHUNK_SIZE):
+    """
+    time the serial WLS and the parallel WLS for each worker count, check
+    the outputs are identical and print the speedup over the serial run
+    """
+    t0 = time.perf_counter()
+    ref = WLS_pos_vel_estimation(obs_filename, eph_filename)
+    t_serial = time.perf_counter() - t0
+    print("%8s %10s %8s %10s" % ("workers", "time(s)", "speedup", "identical"))
+    print("%8s %10.3f %8.2f %10s" % ("serial", t_serial, 1.0, True))
+    curve = []
+    for n in workers:
+        t0 = time.perf_counter()
+        out = WLS_pos_vel_estimation_parallel(obs_filename, eph_filename, n, chunk_size)
+        t = time.perf_counter() - t0
+        same = np.array_equal(np.array(out), np.array(ref))
+        print("%8d %10.3f %8.2f %10s" % (n, t, t_serial / t, same))
+        curve.append((n, t, t_serial / t, same))
+    return curve